@@ -1,7 +1,8 @@
 from fastapi import FastAPI, HTTPException, Depends
 from pydantic import BaseModel
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+import asyncio
 import logging
 from typing import Optional
 
@@ -44,17 +45,25 @@ async def classify_user(data: UserData):
     Menerima data error pengguna, menghitung ulang EQ,
     dan mengklasifikasikan performa pengguna berdasarkan EQ rata-rata terbaru.
     """
+    # Semua service bersifat sinkron (HTTP ke Supabase + CPU), jalankan di thread
+    # agar event loop tidak terblokir selama request berlangsung
     try:
         # 1. Simpan error snapshot terbaru (tetap penting untuk history)
-        supabase_service.save_raw_error_snapshot(
+        # Harus selesai sebelum langkah 2 karena process_user_eq membaca ulang feedback user
+        saved_event = await asyncio.to_thread(
+            supabase_service.save_raw_error_snapshot,
             user_id=data.user_id,
             project_id=data.project_id,
             error_snapshot=data.error_snapshot,
             code_snapshot=data.code_snapshot
         )
 
-        # 2. Proses ulang EQ (Ini akan insert new history dan update average_eq di eq_metrics)
-        average_eq = eq_service.process_user_eq(data.user_id)
+        # 2. Proses ulang EQ secara inkremental (hanya sesi terakhir dihitung ulang;
+        #    upsert history sesi tersebut dan update average_eq di eq_metrics).
+        #    Event yang baru disimpan diteruskan agar sesi baru bisa dihitung tanpa fetch ulang.
+        average_eq = await asyncio.to_thread(
+            eq_service.process_user_eq_incremental, data.user_id, new_event=saved_event
+        )
 
         # 3. Lakukan prediksi performa berdasarkan EQ rata-rata terbaru
         if average_eq is None or average_eq < 0:
@@ -64,7 +73,8 @@ async def classify_user(data: UserData):
 
         # 4. FINAL UPDATE: Sinkronkan cluster/performance ke eq_metrics dan SEMUA history records
         # Ini akan memastikan record history yang baru di-insert di langkah 2 terupdate
-        supabase_service.final_prediction_update(
+        await asyncio.to_thread(
+             supabase_service.final_prediction_update,
              user_id=data.user_id,
              cluster_label=cluster_label,
              performance=performance,
@@ -81,24 +91,59 @@ async def classify_user(data: UserData):
         logger.error(f"Error during classification for user {data.user_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal server error during classification.")
 
-# Konfigurasi dan mulai scheduler untuk retraining (tidak berubah)
-scheduler = BackgroundScheduler(timezone='Asia/Jakarta') # Pastikan timezone di set
-scheduler.add_job(
-    prediction_service.retrain_model,
-    CronTrigger(hour=0, minute=0), # Setiap hari jam 00:00 WIB
-    id="retrain_model_job",
-    name="Daily EQ model retraining job",
-    replace_existing=True
-)
-try:
-    scheduler.start()
-    logger.info("Scheduler started for daily EQ model retraining at 00:00 WIB.")
-except Exception as e:
-     logger.error(f"Failed to start scheduler: {e}", exc_info=True)
+# Konfigurasi scheduler untuk retraining: AsyncIOScheduler memakai event loop FastAPI,
+# tidak perlu thread scheduler tersendiri
+scheduler = AsyncIOScheduler(timezone='Asia/Jakarta') # Pastikan timezone di set
+
+
+async def run_retrain_job():
+    """Menjalankan retraining (sinkron, CPU + I/O) di thread agar event loop tetap bebas."""
+    await asyncio.to_thread(prediction_service.retrain_model)
+
+
+async def run_eq_reconciliation_job():
+    """
+    Menghitung ulang EQ semua user dari feedback (di thread) sebagai rekonsiliasi malam hari,
+    untuk memperbaiki state inkremental yang tertinggal akibat penulisan yang gagal di /classify.
+    """
+    await asyncio.to_thread(eq_service.calculate_historical_eq_all_users)
+
+
+# Scheduler harus dimulai di dalam event loop yang sedang berjalan
+@app.on_event("startup")
+async def start_scheduler():
+    # Singleton: jangan daftarkan/mulai ulang jika scheduler sudah berjalan (misal saat reload)
+    if scheduler.running:
+        logger.info("Scheduler already running, skipping start.")
+        return
+    # Rekonsiliasi EQ dijalankan sebelum retraining, agar model dilatih dengan metrik yang sudah diperbaiki
+    scheduler.add_job(
+        run_eq_reconciliation_job,
+        CronTrigger(hour=23, minute=0, timezone='Asia/Jakarta'), # Setiap hari jam 23:00 WIB
+        id="eq_reconciliation_job",
+        name="Nightly EQ reconciliation job",
+        replace_existing=True,
+        coalesce=True,
+        max_instances=1 # Cegah dua rekonsiliasi berjalan bersamaan
+    )
+    scheduler.add_job(
+        run_retrain_job,
+        CronTrigger(hour=0, minute=0, timezone='Asia/Jakarta'), # Setiap hari jam 00:00 WIB
+        id="retrain_model_job",
+        name="Daily EQ model retraining job",
+        replace_existing=True,
+        coalesce=True, # Gabungkan eksekusi yang tertunda menjadi satu
+        max_instances=1 # Cegah dua retraining berjalan bersamaan
+    )
+    try:
+        scheduler.start()
+        logger.info("Scheduler started for nightly EQ reconciliation at 23:00 WIB and daily EQ model retraining at 00:00 WIB.")
+    except Exception as e:
+         logger.error(f"Failed to start scheduler: {e}", exc_info=True)
 
 
 @app.on_event("shutdown")
 def shutdown_scheduler():
     if scheduler.running:
         scheduler.shutdown()
-        logger.info("Scheduler has been shut down.")
\ No newline at end of file
+        logger.info("Scheduler has been shut down.")
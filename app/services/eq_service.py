@@ -1,7 +1,11 @@
 import logging
 import re
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import ExitStack
+from functools import lru_cache, wraps
 from datetime import datetime, timedelta, timezone
-from typing import List, Dict, Tuple, Optional
+from typing import Iterable, List, Dict, Tuple, Optional
 import pandas as pd
 import numpy as np
 
@@ -41,15 +45,89 @@ COUNTED_ERROR_TYPES = {
     'error_illegal_start_of_type': r'illegal start of type'
 }
 
+# Urutan tetap tipe error counted; error counts disimpan sebagai array int32 dengan urutan ini
+COUNTED_KEYS = tuple(COUNTED_ERROR_TYPES)
+
+_REGEX_METACHARS = set('.^$*+?{}[]\\|()')
+
+def _is_literal(pattern: str) -> bool:
+    """True jika pola tidak memakai metakarakter regex (cocok dicek dengan substring biasa)."""
+    return not _REGEX_METACHARS.intersection(pattern)
+
+# Substring wajib (cukup salah satu) untuk pola yang memakai metakarakter regex.
+# Pola literal memakai dirinya sendiri sebagai substring wajib.
+_REGEX_PATTERN_NEEDLES = {
+    'error_constructor': ('constructor',),
+    'bracket_expected': ('{ expected', '( expected', 'illegal start of expression'),
+    'dot_class_expected': ('.class expected',),
+    'missing_return': ('missing return',),
+    'method_application_error': ('cannot be applied to', 'actual and formal argument lists differ'),
+}
+
+def _needles(key: str, pattern: str) -> Tuple[str, ...]:
+    """Substring yang pasti muncul jika 'pattern' cocok (dipakai sebagai pre-filter murah sebelum regex)."""
+    return (pattern,) if _is_literal(pattern) else _REGEX_PATTERN_NEEDLES[key]
+
+def _tethered_matchers(pattern_map: Dict[str, str]) -> List[Tuple[str, Tuple[str, ...], Optional[re.Pattern]]]:
+    """
+    Menyusun (key, substring wajib, regex) per pola, urut sesuai dict. Regex "ditambatkan" ke
+    substring wajibnya: hanya dijalankan jika substring itu muncul, sehingga engine tidak mencoba
+    pola di setiap posisi teks. Pola literal tidak butuh regex sama sekali (regex = None).
+    """
+    return [
+        (k, _needles(k, v), None if _is_literal(v) else re.compile(v))
+        for k, v in pattern_map.items()
+    ]
+
+# Matcher tipe error EQ (urutan = prioritas) dan matcher error counts
+_EQ_TYPE_MATCHERS = _tethered_matchers(patterns)
+_COUNTED_MATCHERS = _tethered_matchers(COUNTED_ERROR_TYPES)
+
+# Matcher gabungan untuk satu kali scan per snapshot: (tipe EQ atau None, indeks counts atau -1,
+# substring wajib, regex). Pola counted yang identik dengan pola EQ cukup dicek sekali.
+_FUSED_MATCHERS = [
+    (key, COUNTED_KEYS.index(key) if COUNTED_ERROR_TYPES.get(key) == patterns[key] else -1, needles, regex)
+    for key, needles, regex in _EQ_TYPE_MATCHERS
+] + [
+    (None, i, needles, regex)
+    for i, (key, needles, regex) in enumerate(_COUNTED_MATCHERS)
+    if patterns.get(key) != COUNTED_ERROR_TYPES[key]
+]
+# Setelah posisi ini tidak ada lagi pola counted, jadi scan bisa berhenti begitu tipe EQ ditemukan
+_FUSED_LAST_COUNTED = max(
+    (pos for pos, (_, count_index, _, _) in enumerate(_FUSED_MATCHERS) if count_index >= 0), default=-1
+)
+# Prioritas tipe error sesuai urutan di 'patterns' (tipe pertama yang cocok yang dipakai)
+_EQ_TYPE_PRIORITY = {k: i for i, k in enumerate(patterns)}
+
 # Parameter EQ (berdasarkan Tabel 4.2 - From Search di PDF)
 ETYPE_SAME_PENALTY = 11
 ETYPE_DIFF_PENALTY = 8
 MAX_PENALTY = max(ETYPE_SAME_PENALTY, ETYPE_DIFF_PENALTY) # Skor maksimum per pasangan (karena eline_penalty=0)
 
+# Jeda maksimum antar event dalam satu sesi (menit)
+SESSION_MAX_GAP_MINUTES = 30
+
+# Jumlah user yang diproses bersamaan saat kalkulasi historis (pekerjaan didominasi I/O Supabase)
+HISTORICAL_MAX_WORKERS = 16
+
+# Jumlah user yang hasilnya dikumpulkan sebelum ditulis ke database dalam satu batch (kalkulasi historis)
+HISTORICAL_FLUSH_USERS = 100
+
+# Sufiks zona waktu di akhir string timestamp (misal '+07:00', '-0500', '+00')
+_TZ_SUFFIX_PATTERN = re.compile(r'([-+]\d{2}(:?\d{2})?)$')
+
 def parse_flexible_isoformat(ts_str: Optional[str]) -> Optional[datetime]:
     """Mencoba parsing string ISO format dengan mikrodetik yang bervariasi."""
     if not ts_str:
         return None
+    # Jalur cepat: datetime.fromisoformat (C) sudah menangani 'Z' dan mikrodetik 1-6+ digit di Python 3.11+
+    try:
+        parsed = datetime.fromisoformat(ts_str)
+        # Timestamp tanpa offset dianggap UTC
+        return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=timezone.utc)
+    except ValueError:
+        pass # Lanjut ke jalur normalisasi manual (Python lama / format tidak standar)
     try:
         # Penanganan zona waktu
         if ts_str.endswith('Z'):
@@ -65,7 +143,7 @@ def parse_flexible_isoformat(ts_str: Optional[str]) -> Optional[datetime]:
 
             tz_part = ''
             # Cari zona waktu di akhir
-            tz_match = re.search(r'([-+]\d{2}(:?\d{2})?)$', fractional_part_with_tz)
+            tz_match = _TZ_SUFFIX_PATTERN.search(fractional_part_with_tz)
             if tz_match:
                  tz_part = tz_match.group(0)
                  micro = fractional_part_with_tz[:-len(tz_part)]
@@ -85,90 +163,174 @@ def parse_flexible_isoformat(ts_str: Optional[str]) -> Optional[datetime]:
          return None
 
 
-def get_specific_error_counts(error_snapshot: str) -> Dict[str, int]:
-    """Menghitung apakah event error termasuk dalam 6 tipe error yang disimpan."""
-    counts = {k: 0 for k in COUNTED_ERROR_TYPES.keys()}
-    if not isinstance(error_snapshot, str) or not error_snapshot.strip():
-        return counts
+def counts_to_dict(counts: np.ndarray) -> Dict[str, int]:
+    """Mengubah array error counts (urutan COUNTED_KEYS) menjadi dict kolom tabel."""
+    return dict(zip(COUNTED_KEYS, counts.tolist()))
+
 
-    lowered_snapshot = error_snapshot.lower()
+def _is_blank(error_snapshot) -> bool:
+    """True jika snapshot bukan string atau hanya berisi whitespace (tanpa membuat salinan seperti strip())."""
+    return not isinstance(error_snapshot, str) or not error_snapshot or error_snapshot.isspace()
 
-    for error_type, pattern in COUNTED_ERROR_TYPES.items():
-        if re.search(pattern, lowered_snapshot):
-            counts[error_type] = 1 # Hanya 1 karena ini adalah per event error
-    return counts
+
+# Error counts nol (read-only) untuk snapshot kosong/bukan string, dipakai bersama tanpa alokasi baru
+_ZERO_COUNTS = np.zeros(len(COUNTED_KEYS), dtype=np.int32)
+_ZERO_COUNTS.setflags(write=False)
+
+
+def get_specific_error_counts(error_snapshot: str) -> Dict[str, int]:
+    """Menghitung apakah event error termasuk dalam 6 tipe error yang disimpan."""
+    if _is_blank(error_snapshot):
+        return counts_to_dict(_ZERO_COUNTS)
+    _, counts = _analyze_snapshot_cached(error_snapshot)
+    return counts_to_dict(counts)
 
 
 def parse_error_details(error_snapshot: str) -> Tuple[Optional[str], Optional[int]]:
     """Mengekstrak tipe error PERTAMA dan nomor baris."""
-    if not isinstance(error_snapshot, str) or not error_snapshot.strip():
+    if _is_blank(error_snapshot):
         return None, None
 
-    lowered_snapshot = error_snapshot.lower()
     error_line = None
 
     # Cari nomor baris error
     match = ERROR_LINE_PATTERN.search(error_snapshot)
     error_line = int(match.group(2)) if match else None
 
-    # Identifikasi tipe error EQ (ambil yang pertama cocok)
-    error_type = None
-    for type_key, pattern in patterns.items():
-        if re.search(pattern, lowered_snapshot):
-            error_type = type_key
-            break
+    # Identifikasi tipe error EQ (ambil yang pertama cocok menurut urutan 'patterns')
+    error_type, _ = _analyze_snapshot_cached(error_snapshot)
 
     # Catatan: nomor baris (error_line) diekstrak tapi tidak digunakan
     # dalam perhitungan skor EQ sesuai parameter optimal PDF (eline_penalty=0)
     return error_type, error_line
 
 
-def identify_sessions(user_events: List[Dict], max_gap_minutes: int = 30) -> List[List[Dict]]:
-    """Mengelompokkan event error pengguna menjadi sesi berdasarkan jeda waktu."""
-    if not user_events:
-        return []
+def _analyze_lowered(lowered_snapshot: str) -> Tuple[Optional[str], np.ndarray]:
+    """Tipe error EQ dan error counts dalam satu kali scan atas snapshot yang sudah di-lowercase."""
+    error_type = None
+    counts = np.zeros(len(COUNTED_KEYS), dtype=np.int32)
+    for pos, (eq_type, count_index, needles, regex) in enumerate(_FUSED_MATCHERS):
+        if error_type is not None and pos > _FUSED_LAST_COUNTED:
+            break
+        if error_type is not None and count_index < 0:
+            continue
+        if any(needle in lowered_snapshot for needle in needles):
+            if regex is None or regex.search(lowered_snapshot):
+                if error_type is None and eq_type is not None:
+                    error_type = eq_type
+                if count_index >= 0:
+                    counts[count_index] = 1 # Hanya 1 karena ini adalah per event error
+    return error_type, counts
+
+
+@lru_cache(maxsize=4096)
+def _analyze_snapshot_cached(error_snapshot: str) -> Tuple[Optional[str], np.ndarray]:
+    """
+    Hasil parse (tipe error, error counts) per snapshot unik (string tidak kosong) dalam satu kali lowercase.
+    Nomor baris tidak diekstrak karena tidak dipakai skor EQ. Array counts dibuat read-only.
+    """
+    error_type, counts = _analyze_lowered(error_snapshot.lower())
+    counts.setflags(write=False)
+    return error_type, counts
+
+
+def analyze_event(event: Dict) -> Tuple[Optional[str], np.ndarray]:
+    """
+    Mengembalikan (tipe error, error counts array) untuk satu event.
+    Event tidak diubah; snapshot yang sama tidak di-parse ulang berkat cache per snapshot.
+    Snapshot kosong/bukan string disaring di sini sekali, sehingga fungsi di bawahnya selalu menerima string berisi.
+    """
+    snapshot = event.get('error_snapshot')
+    if _is_blank(snapshot):
+        return None, _ZERO_COUNTS
+    return _analyze_snapshot_cached(snapshot)
+
 
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_ONE_MICROSECOND = timedelta(microseconds=1)
+
+def _group_sessions(user_events: Iterable[Dict], max_gap_minutes: int = SESSION_MAX_GAP_MINUTES) -> Tuple[List[List[Dict]], List[Tuple[datetime, datetime]]]:
+    """
+    Seperti identify_sessions, tetapi juga mengembalikan (waktu mulai, waktu akhir) per sesi.
+    Waktu hasil parse disimpan di list paralel, bukan ditulis ke dict event milik pemanggil.
+    'user_events' cukup berupa iterable (misal halaman Supabase yang di-stream); dibaca tepat satu kali.
+    """
     parsed_events = []
+    parsed_times = []
+    # Event dengan timestamp tidak valid hanya dihitung, lalu dilaporkan dalam satu log setelah loop
+    skipped_count = 0
+    skipped_sample = None
     for event in user_events:
         event_time = parse_flexible_isoformat(event.get('created_at'))
         if event_time:
              # Hanya tambahkan event jika timestamp berhasil di-parse
-             event['parsed_time'] = event_time
              parsed_events.append(event)
+             parsed_times.append(event_time)
         else:
-            logger.warning(f"Skipping event due to unparseable timestamp: {event.get('created_at')}")
+            if skipped_count == 0:
+                skipped_sample = event.get('created_at')
+            skipped_count += 1
 
-    if not parsed_events:
-         logger.warning("No valid events found after parsing timestamps.")
-         return []
+    if skipped_count:
+        logger.warning(f"Skipping {skipped_count} events due to unparseable timestamps (e.g. {skipped_sample}).")
 
-    # Urutkan event berdasarkan waktu
-    parsed_events.sort(key=lambda x: x['parsed_time'])
+    if not parsed_events:
+         if skipped_count:
+             logger.warning("No valid events found after parsing timestamps.")
+         return [], []
+
+    # Waktu event sebagai integer mikrodetik sejak epoch (eksak, tanpa pembulatan float)
+    event_times_us = np.fromiter(
+        ((event_time - _EPOCH) // _ONE_MICROSECOND for event_time in parsed_times),
+        dtype=np.int64, count=len(parsed_times)
+    )
+    time_gaps_us = np.diff(event_times_us)
+
+    # Urutkan event berdasarkan waktu (stable, sama seperti list.sort). Data dari Supabase
+    # biasanya sudah urut created_at, sehingga pengurutan ulang hanya dilakukan jika perlu.
+    if (time_gaps_us < 0).any():
+        order = np.argsort(event_times_us, kind='stable')
+        parsed_events = [parsed_events[i] for i in order]
+        parsed_times = [parsed_times[i] for i in order]
+        time_gaps_us = np.diff(event_times_us[order])
+
+    # Sesi baru dimulai di setiap event yang jedanya dari event sebelumnya melebihi batas
+    max_gap_us = max_gap_minutes * 60 * 1_000_000
+    boundaries = (np.flatnonzero(time_gaps_us > max_gap_us) + 1).tolist()
+    starts = [0] + boundaries
+    ends = boundaries + [len(parsed_events)]
+    sessions = [parsed_events[start:end] for start, end in zip(starts, ends)]
+    session_bounds = [(parsed_times[start], parsed_times[end - 1]) for start, end in zip(starts, ends)]
 
-    sessions = []
-    current_session = [parsed_events[0]] # Mulai sesi pertama dengan event pertama
-    last_event_time = parsed_events[0]['parsed_time']
+    logger.info(f"Identified {len(sessions)} sessions from {len(parsed_events)} valid events.")
+    return sessions, session_bounds
 
-    for event in parsed_events[1:]: # Mulai dari event kedua
-        event_time = event['parsed_time']
 
-        # Jika jeda waktu terlalu besar, mulai sesi baru
-        if (event_time - last_event_time) > timedelta(minutes=max_gap_minutes):
-            if current_session: # Simpan sesi sebelumnya jika tidak kosong
-                sessions.append(current_session)
-            current_session = [event] # Sesi baru dimulai dengan event ini
-        else:
-            # Jika jeda waktu masih dalam batas, tambahkan ke sesi saat ini
-            current_session.append(event)
+def identify_sessions(user_events: List[Dict], max_gap_minutes: int = SESSION_MAX_GAP_MINUTES) -> List[List[Dict]]:
+    """Mengelompokkan event error pengguna menjadi sesi berdasarkan jeda waktu."""
+    return _group_sessions(user_events, max_gap_minutes)[0]
 
-        last_event_time = event_time
 
-    # Jangan lupa simpan sesi terakhir
-    if current_session:
-        sessions.append(current_session)
+def _session_eq_from_codes(type_codes: np.ndarray, code_changed: np.ndarray) -> float:
+    """
+    Kernel numerik EQ satu sesi: hanya operasi array (tanpa regex/dict),
+    dipisah dari tahap ekstraksi agar bisa diganti/di-compile tersendiri.
+    type_codes: kode tipe error per event (-1 = bukan error sintaks).
+    code_changed: per pasangan, True jika snapshot berubah.
+    """
+    prev_codes, curr_codes = type_codes[:-1], type_codes[1:]
+    # Skor hanya diberikan jika KEDUA event adalah error sintaks (punya tipe error):
+    # penalti tinggi jika tipe sama, lebih rendah jika tipe beda, selain itu 0.
+    # Penalti lokasi (eline_penalty) = 0 sesuai parameter optimal PDF Tabel 4.2
+    both_errors = (prev_codes >= 0) & (curr_codes >= 0)
+    pair_scores = np.where(both_errors, np.where(prev_codes == curr_codes, ETYPE_SAME_PENALTY, ETYPE_DIFF_PENALTY), 0)
+    valid_pairs = int(code_changed.sum())
 
-    logger.info(f"Identified {len(sessions)} sessions from {len(parsed_events)} valid events.")
-    return sessions
+    # Rata-rata skor ternormalisasi = total skor / (jumlah pasangan * pembagi 11, sesuai parameter optimal PDF)
+    # Jika tidak ada pasangan valid (misal semua snapshot sama) -> 0
+    if not valid_pairs:
+        return 0.0
+    return int(pair_scores[code_changed].sum()) / (valid_pairs * MAX_PENALTY)
 
 
 def calculate_session_eq(session_events: List[Dict]) -> Tuple[float, Dict[str, int]]:
@@ -177,71 +339,184 @@ def calculate_session_eq(session_events: List[Dict]) -> Tuple[float, Dict[str, i
     Menggunakan parameter optimal dari Jadud (2006) Tabel 4.2.
     Mengembalikan (eq_score, total_error_counts).
     """
-    if len(session_events) < 2:
-        # Jika hanya 0 atau 1 event, EQ tidak bisa dihitung (tidak ada pasangan)
-        # Hitung error counts untuk satu event jika ada
-        initial_counts = {k: 0 for k in COUNTED_ERROR_TYPES.keys()}
-        if len(session_events) == 1:
-            snapshot = session_events[0].get('error_snapshot')
-            if snapshot:
-                initial_counts = get_specific_error_counts(snapshot)
-        return 0.0, initial_counts
-
-    pair_scores = []
-    session_error_counts = {k: 0 for k in COUNTED_ERROR_TYPES.keys()}
-
-    # Proses event-event, ambil detail error dan snapshot mentah
-    parsed_details = []
-    for event in session_events:
+    session_eq_score, session_error_counts = _calculate_session_eq_array(session_events)
+    return session_eq_score, counts_to_dict(session_error_counts)
+
+
+def _analyze_events(events: List[Dict]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Satu pass atas daftar event: kode tipe error per event (int8, -1 jika bukan error sintaks),
+    matriks error counts (int32, event x COUNTED_KEYS), dan ID snapshot per event (int64),
+    semuanya dialokasikan sekali. Snapshot yang sama mendapat ID yang sama, sedangkan snapshot
+    None selalu mendapat ID unik (negatif) sehingga tidak pernah dianggap "tidak berubah".
+    """
+    type_codes = np.empty(len(events), dtype=np.int8)
+    count_matrix = np.empty((len(events), len(COUNTED_KEYS)), dtype=np.int32)
+    snapshot_ids = np.empty(len(events), dtype=np.int64)
+    ids_map = {}
+    for i, event in enumerate(events):
+        error_type, counts = analyze_event(event)
+        type_codes[i] = _EQ_TYPE_PRIORITY.get(error_type, -1)
+        count_matrix[i] = counts
         snapshot = event.get('error_snapshot')
-        details = parse_error_details(snapshot)
-        parsed_details.append((details, snapshot))
+        snapshot_ids[i] = -(i + 1) if snapshot is None else ids_map.setdefault(snapshot, len(ids_map))
+    return type_codes, count_matrix, snapshot_ids
 
-    # --- Hitung skor EQ berdasarkan pasangan ---
-    for i in range(1, len(parsed_details)):
-        prev_event_details, prev_snapshot = parsed_details[i-1] # Ambil detail dan snapshot sebelumnya
-        curr_event_details, curr_snapshot = parsed_details[i]   # Ambil detail dan snapshot saat ini
-
-        # --- REVISI: Filter pasangan tanpa perubahan kode ---
-        # Periksa apakah ada perubahan kode (snapshot error berbeda)
-        # Jika snapshot sama persis, lewati pasangan ini (sesuai footnote PDF Gambar 4.4)
-        # Pastikan snapshot tidak None sebelum membandingkan
-        if prev_snapshot is not None and prev_snapshot == curr_snapshot:
-            # logger.debug(f"Skipping pair {i-1}-{i}: No code change detected (snapshots identical).") # Opsional logging
-            continue # Lanjut ke pasangan event berikutnya
-        # --- AKHIR REVISI ---
-
-        prev_error_type, _ = prev_event_details if prev_event_details else (None, None)
-        curr_error_type, _ = curr_event_details if curr_event_details else (None, None)
-
-        # Hitung skor EQ
-        pair_score = 0 # Default skor 0
-        # Hanya hitung skor jika KEDUA event adalah error sintaks (punya tipe error)
-        if prev_error_type is not None and curr_error_type is not None:
-            if prev_error_type == curr_error_type:
-                pair_score = ETYPE_SAME_PENALTY # Penalti tinggi jika tipe sama
-            else:
-                pair_score = ETYPE_DIFF_PENALTY # Penalti lebih rendah jika tipe beda
-            # Penalti lokasi (eline_penalty) = 0 sesuai parameter optimal PDF Tabel 4.2
 
-        # Normalisasi skor (Pembagi 11 sudah benar sesuai parameter optimal PDF)
-        normalized_score = pair_score / MAX_PENALTY if MAX_PENALTY > 0 else 0
-        pair_scores.append(normalized_score)
+def _analyze_sessions(sessions: List[List[Dict]]) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Menganalisis semua event user sekaligus lalu membaginya menjadi potongan (view) per sesi."""
+    all_arrays = _analyze_events([event for session in sessions for event in session])
+    session_arrays = []
+    start = 0
+    for session in sessions:
+        end = start + len(session)
+        session_arrays.append(tuple(array[start:end] for array in all_arrays))
+        start = end
+    return session_arrays
+
+
+def _calculate_session_eq_array(session_events: List[Dict], type_codes: Optional[np.ndarray] = None,
+                                count_matrix: Optional[np.ndarray] = None,
+                                snapshot_ids: Optional[np.ndarray] = None) -> Tuple[float, np.ndarray]:
+    """
+    Seperti calculate_session_eq, tetapi error counts dikembalikan sebagai array (urutan COUNTED_KEYS).
+    type_codes/count_matrix/snapshot_ids hasil _analyze_sessions bisa diberikan agar event tidak dianalisis ulang.
+    """
+    if type_codes is None or count_matrix is None or snapshot_ids is None:
+        type_codes, count_matrix, snapshot_ids = _analyze_events(session_events)
 
     # --- Akumulasi error counts untuk SEMUA event dalam sesi ---
-    for _, snapshot in parsed_details: # Iterasi melalui semua detail yang sudah diproses
-        if snapshot: # Hanya proses jika snapshot ada
-            current_event_counts = get_specific_error_counts(snapshot)
-            for key, count in current_event_counts.items():
-                session_error_counts[key] += count
+    session_error_counts = count_matrix.sum(axis=0, dtype=np.int32)
+
+    if len(session_events) < 2:
+        # Jika hanya 0 atau 1 event, EQ tidak bisa dihitung (tidak ada pasangan)
+        return 0.0, session_error_counts
 
-    # Hitung rata-rata skor ternormalisasi untuk sesi ini
-    # Jika tidak ada pasangan yang valid (misal semua snapshot sama), pair_scores kosong
-    session_eq_score = np.mean(pair_scores) if pair_scores else 0.0
+    # --- REVISI: Filter pasangan tanpa perubahan kode ---
+    # Jika snapshot sama persis, pasangan dilewati (sesuai footnote PDF Gambar 4.4)
+    # Snapshot sudah dipetakan ke ID integer, jadi cukup bandingkan ID (snapshot None selalu berubah)
+    code_changed = snapshot_ids[1:] != snapshot_ids[:-1]
+
+    # --- Hitung skor EQ berdasarkan pasangan ---
+    session_eq_score = _session_eq_from_codes(type_codes, code_changed)
 
     return float(session_eq_score), session_error_counts
 
 
+def _score_sessions(user_id: str, sessions: List[List[Dict]], session_bounds: List[Tuple[datetime, datetime]],
+                    now_iso: str) -> Tuple[List[float], Dict[str, int], List[Dict]]:
+    """
+    Menghitung EQ dan error counts untuk daftar sesi milik satu user.
+    session_bounds: (waktu mulai, waktu akhir) per sesi hasil _group_sessions.
+    Mengembalikan (EQ per sesi, total error counts, record history untuk eq_metrics_history).
+    """
+    session_eqs = []
+    cumulative_error_counts = np.zeros(len(COUNTED_KEYS), dtype=np.int32)
+    history_records = []
+
+    # Tipe error & error counts semua event dihitung dalam satu pass, lalu dipotong per sesi
+    session_arrays = _analyze_sessions(sessions)
+
+    for session_idx, (session, (start_time, end_time), (type_codes, count_matrix, snapshot_ids)) in enumerate(zip(sessions, session_bounds, session_arrays)):
+        if not session: # Pastikan sesi tidak kosong
+             logger.warning(f"Skipping empty or invalid session {session_idx+1} for user {user_id}")
+             continue
+
+        # Hitung EQ dan Error Counts per sesi
+        try:
+            session_eq, session_error_counts = _calculate_session_eq_array(session, type_codes, count_matrix, snapshot_ids)
+        except Exception as calc_err:
+             logger.error(f"Error calculating EQ for session {session_idx+1} (user {user_id}): {calc_err}", exc_info=True)
+             continue # Lewati sesi ini jika perhitungan gagal
+
+        session_eqs.append(session_eq)
+
+        # Akumulasi Error Counts ke total user
+        cumulative_error_counts += session_error_counts
+
+        # Siapkan data untuk history (eq_metrics_history)
+        history_record = {
+            "user_id": user_id,
+            "session_eq_score": session_eq,
+            "session_start_time": start_time.isoformat(),
+            "session_end_time": end_time.isoformat(),
+            "session_compilations": len(session), # Ganti nama kolom jika perlu
+            "recorded_at": now_iso,
+            # Tambahkan 6 kolom error counts sesi
+            **counts_to_dict(session_error_counts)
+        }
+        history_records.append(history_record)
+
+    return session_eqs, counts_to_dict(cumulative_error_counts), history_records
+
+
+def _compute_user_eq(user_id: str, user_events: Optional[List[Dict]] = None) -> Optional[Tuple[List[Dict], Dict]]:
+    """
+    Menghitung EQ per sesi dan metrik agregat user tanpa menulis ke database.
+    Feedback user diambil dari database kecuali sudah diberikan lewat 'user_events'.
+    Mengembalikan (record history, data eq_metrics) atau None jika tidak ada sesi yang bisa dihitung.
+    """
+    if user_events is None:
+        # Halaman feedback di-stream langsung ke pengelompokan sesi, tanpa list perantara
+        user_events = supabase_service.iter_feedback_for_user(user_id)
+
+    sessions, session_bounds = _group_sessions(user_events)
+    if not sessions:
+         logger.warning(f"No feedback events or valid sessions found for user {user_id}. Skipping EQ calculation.")
+         return None
+
+    # Satu timestamp untuk seluruh batch (dipakai recorded_at & last_calculated_at)
+    now_iso = datetime.now(timezone.utc).isoformat()
+
+    logger.info(f"Calculating EQ for {len(sessions)} sessions for user {user_id}...")
+    all_session_eqs, cumulative_error_counts, history_records = _score_sessions(user_id, sessions, session_bounds, now_iso)
+
+    # Jika tidak ada sesi valid yang bisa diproses setelah loop
+    if not all_session_eqs:
+         logger.warning(f"No valid session EQ scores could be calculated for user {user_id}.")
+         return None
+
+    # Hitung EQ rata-rata keseluruhan (list float biasa, tidak perlu dikonversi ke array NumPy)
+    average_eq = sum(all_session_eqs) / len(all_session_eqs) # all_session_eqs dijamin tidak kosong di sini
+
+    # Siapkan data agregat untuk eq_metrics
+    metrics_data = {
+        'user_id': user_id,
+        'average_eq_score': float(average_eq),
+        'total_sessions_analyzed': len(all_session_eqs), # Jumlah sesi yang berhasil dihitung EQnya
+        'last_calculated_at': now_iso,
+        # Tambahkan 6 kolom error counts total KESELURUHAN
+        **cumulative_error_counts
+    }
+    return history_records, metrics_data
+
+
+# Kunci per user: perhitungan EQ untuk user yang sama tidak boleh tumpang tindih, karena prune history
+# pada perhitungan penuh bisa menghapus sesi yang baru saja di-upsert oleh panggilan lain.
+# RLock karena process_user_eq_incremental bisa jatuh kembali ke process_user_eq.
+_user_locks: Dict[str, threading.RLock] = {}
+_user_locks_guard = threading.Lock()
+
+
+def _user_lock(user_id: str) -> threading.RLock:
+    """Kunci milik user_id (dibuat saat pertama kali dibutuhkan)."""
+    with _user_locks_guard:
+        lock = _user_locks.get(user_id)
+        if lock is None:
+            lock = _user_locks[user_id] = threading.RLock()
+        return lock
+
+
+def _serialized_per_user(func):
+    """Menjalankan func(user_id, ...) sambil memegang kunci user tersebut."""
+    @wraps(func)
+    def wrapper(user_id: str, *args, **kwargs):
+        with _user_lock(user_id):
+            return func(user_id, *args, **kwargs)
+    return wrapper
+
+
+@_serialized_per_user
 def process_user_eq(user_id: str):
     """
     Memproses semua feedback untuk user, menghitung EQ per sesi,
@@ -250,139 +525,256 @@ def process_user_eq(user_id: str):
     """
     logger.info(f"Processing EQ for user {user_id}...")
     try:
-        user_events = supabase_service.fetch_all_feedback_for_user(user_id)
-        if not user_events:
-            logger.warning(f"No feedback events found for user {user_id}. Skipping EQ calculation.")
+        computed = _compute_user_eq(user_id)
+        if computed is None:
             # Kembalikan None agar /classify tahu tidak ada data EQ
             return None
+        history_records, metrics_data = computed
 
-        sessions = identify_sessions(user_events)
-        if not sessions:
-             logger.warning(f"Could not identify any valid sessions for user {user_id}.")
-             # Kembalikan None jika tidak ada sesi valid
-             return None
+        # --- Penyimpanan ke Database ---
+        # Upsert history per sesi (kunci: user_id + session_start_time), lalu buang sesi yang sudah tidak ada.
+        # Jika history gagal disimpan, eq_metrics tidak ditulis agar keduanya tetap konsisten
+        # (perhitungan inkremental berikutnya bergantung pada pasangan ini).
+        if not supabase_service.upsert_eq_metrics_history_batch(history_records):
+            logger.error(f"Failed to save EQ history for user {user_id}. Skipping eq_metrics update.")
+            return None
+        _prune_stale_history({user_id: [record['session_start_time'] for record in history_records]})
 
-        all_session_eqs = []
-        cumulative_error_counts = {k: 0 for k in COUNTED_ERROR_TYPES.keys()} # Ubah nama variabel
-        history_records = []
-
-        logger.info(f"Calculating EQ for {len(sessions)} sessions for user {user_id}...")
-        for session_idx, session in enumerate(sessions):
-            if not session or not session[0].get('parsed_time'): # Pastikan sesi tidak kosong dan punya waktu
-                 logger.warning(f"Skipping empty or invalid session {session_idx+1} for user {user_id}")
-                 continue
-
-            # Hitung EQ dan Error Counts per sesi
-            try:
-                session_eq, session_error_counts = calculate_session_eq(session)
-            except Exception as calc_err:
-                 logger.error(f"Error calculating EQ for session {session_idx+1} (user {user_id}): {calc_err}", exc_info=True)
-                 continue # Lewati sesi ini jika perhitungan gagal
-
-            all_session_eqs.append(session_eq)
-
-            # Akumulasi Error Counts ke total user
-            for key, count in session_error_counts.items():
-                cumulative_error_counts[key] += count
-
-            # Siapkan data untuk history (eq_metrics_history)
-            try:
-                start_time = session[0]['parsed_time']
-                end_time = session[-1]['parsed_time']
-                session_start_iso = start_time.isoformat()
-                session_end_iso = end_time.isoformat()
-            except (IndexError, KeyError, AttributeError) as time_err:
-                 logger.warning(f"Could not determine start/end time for session {session_idx+1} (user {user_id}): {time_err}. Skipping history record.")
-                 continue # Jangan buat record history jika waktu tidak valid
-
-            history_record = {
-                "user_id": user_id,
-                "session_eq_score": session_eq,
-                "session_start_time": session_start_iso,
-                "session_end_time": session_end_iso,
-                "session_compilations": len(session), # Ganti nama kolom jika perlu
-                "recorded_at": datetime.now(timezone.utc).isoformat(),
-                # Tambahkan 6 kolom error counts sesi
-                **session_error_counts
-            }
-            history_records.append(history_record)
-
-        # Jika tidak ada sesi valid yang bisa diproses setelah loop
-        if not all_session_eqs:
-             logger.warning(f"No valid session EQ scores could be calculated for user {user_id}.")
+        # Simpan/update metrik agregat
+        if not supabase_service.upsert_eq_metrics(metrics_data):
+             logger.error(f"Failed to save EQ metrics for user {user_id}.")
              return None
 
-        # --- Penyimpanan ke Database ---
-        # Hapus history lama dan simpan history baru (jika ada)
-        try:
-            supabase_service.delete_eq_metrics_history(user_id)
-            if history_records:
-                supabase_service.insert_eq_metrics_history_batch(history_records)
-            else:
-                 logger.info(f"No new history records to insert for user {user_id}.")
-        except Exception as db_hist_err:
-             logger.error(f"Database error handling history for user {user_id}: {db_hist_err}", exc_info=True)
-             # Pertimbangkan apakah mau lanjut atau stop jika DB error
+        average_eq = metrics_data['average_eq_score']
+        logger.info(f"Successfully processed EQ and error counts for user {user_id}. Average EQ: {average_eq:.4f}")
+        return average_eq # Kembalikan skor rata-rata
+
+    except Exception as e:
+        logger.error(f"General error processing EQ for user {user_id}: {e}", exc_info=True)
+        return None # Kembalikan None jika ada error tak terduga
 
-        # Hitung EQ rata-rata keseluruhan
-        average_eq = np.mean(all_session_eqs) # all_session_eqs dijamin tidak kosong di sini
 
-        # Siapkan data agregat untuk eq_metrics
+def _prune_stale_history(current_session_starts: Dict[str, List[str]]):
+    """
+    Menghapus record eq_metrics_history yang sesinya tidak ada lagi di hasil perhitungan terbaru
+    ({user_id: [session_start_time sesi saat ini]}), termasuk sesi di tengah rentang, bukan hanya yang lebih lama.
+    """
+    if not current_session_starts:
+        return
+    # Dibandingkan sebagai datetime: format timestamp dari database bisa berbeda dengan yang ditulis
+    current = {
+        user_id: {parse_flexible_isoformat(start) for start in starts}
+        for user_id, starts in current_session_starts.items()
+    }
+    existing = supabase_service.fetch_eq_metrics_history_sessions(list(current_session_starts))
+    stale_ids = [
+        record['id'] for record in existing
+        if parse_flexible_isoformat(record.get('session_start_time')) not in current.get(record.get('user_id'), ())
+    ]
+    if stale_ids:
+        logger.info(f"Pruning {len(stale_ids)} stale EQ history records for {len(current_session_starts)} users.")
+        supabase_service.delete_eq_metrics_history_by_ids(stale_ids)
+
+
+def _starts_new_session(user_id: str, new_event: Dict, last_history: Dict) -> bool:
+    """
+    True jika new_event pasti membuka sesi baru sendiri: jedanya dari akhir sesi terakhir
+    melebihi batas dan tidak ada event lain yang belum diproses sejak sesi terakhir.
+    """
+    event_time = parse_flexible_isoformat(new_event.get('created_at'))
+    last_session_end = parse_flexible_isoformat(last_history.get('session_end_time'))
+    if event_time is None or last_session_end is None:
+        return False
+    if event_time - last_session_end <= timedelta(minutes=SESSION_MAX_GAP_MINUTES):
+        return False
+    # Event baru harus satu-satunya event setelah sesi terakhir (cukup cek maksimal 2 baris)
+    pending = supabase_service.fetch_feedback_times_since(user_id, last_session_end.isoformat(), limit=2)
+    return len(pending) == 1
+
+
+@_serialized_per_user
+def process_user_eq_incremental(user_id: str, new_event: Optional[Dict] = None):
+    """
+    Versi inkremental process_user_eq untuk /classify.
+    Sesi yang sudah selesai tidak berubah oleh event baru, jadi hanya sesi terakhir
+    (beserta event sesudahnya) yang dihitung ulang; agregat sisanya diambil dari
+    eq_metrics dan record history terakhir. Jika 'new_event' (event yang baru disimpan)
+    diberikan dan event itu membuka sesi baru, tidak ada feedback yang diambil ulang sama sekali.
+    Jatuh kembali ke process_user_eq jika state tersimpan belum ada atau tidak konsisten.
+    Mengembalikan skor rata-rata EQ terbaru atau None jika gagal.
+    """
+    logger.info(f"Incrementally processing EQ for user {user_id}...")
+    try:
+        metrics = supabase_service.get_user_eq_metrics(user_id)
+        last_history = supabase_service.fetch_latest_eq_metrics_history(user_id)
+        previous_sessions = int(metrics.get('total_sessions_analyzed') or 0) if metrics else 0
+        if previous_sessions <= 0 or not last_history or metrics.get('average_eq_score') is None:
+            logger.info(f"No stored EQ state for user {user_id}. Falling back to full EQ calculation.")
+            return process_user_eq(user_id)
+
+        # History dan eq_metrics ditulis berpasangan dengan timestamp yang sama. History yang lebih baru
+        # dari eq_metrics berarti penulisan eq_metrics sebelumnya gagal: agregat tersimpan tidak bisa dipakai.
+        history_recorded_at = parse_flexible_isoformat(last_history.get('recorded_at'))
+        metrics_calculated_at = parse_flexible_isoformat(metrics.get('last_calculated_at'))
+        if history_recorded_at and metrics_calculated_at and history_recorded_at > metrics_calculated_at:
+            logger.warning(f"EQ metrics for user {user_id} are older than its history. Falling back to full EQ calculation.")
+            return process_user_eq(user_id)
+
+        if new_event is not None and _starts_new_session(user_id, new_event, last_history):
+            # Jalur cepat: event baru adalah sesi baru dengan satu event, sesi lama tidak berubah
+            sessions, session_bounds = _group_sessions([new_event])
+            replaced_history = {}
+        else:
+            last_session_start = parse_flexible_isoformat(last_history.get('session_start_time'))
+            if last_session_start is None:
+                return process_user_eq(user_id)
+
+            # Ambil hanya event sejak awal sesi terakhir (sesi terakhir + event baru).
+            # Jika pengambilan terputus, exception diteruskan dan eq_metrics tidak ditulis.
+            tail_events = supabase_service.iter_feedback_for_user(user_id, since=last_session_start.isoformat())
+            sessions, session_bounds = _group_sessions(tail_events)
+            if not sessions or session_bounds[0][0] != last_session_start:
+                logger.warning(f"Stored EQ state for user {user_id} does not match feedback. Falling back to full EQ calculation.")
+                return process_user_eq(user_id)
+            # Sesi terakhir yang tersimpan akan diganti dengan hasil hitung ulang
+            replaced_history = last_history
+
+        now_iso = datetime.now(timezone.utc).isoformat()
+        tail_session_eqs, tail_error_counts, history_records = _score_sessions(user_id, sessions, session_bounds, now_iso)
+        if len(history_records) != len(sessions):
+            logger.warning(f"Could not rescore all tail sessions for user {user_id}. Falling back to full EQ calculation.")
+            return process_user_eq(user_id)
+
+        # Ganti kontribusi sesi yang dihitung ulang (jika ada) dengan hasil sesi ekor
+        total_sessions = previous_sessions - (1 if replaced_history else 0) + len(tail_session_eqs)
+        eq_sum = (float(metrics['average_eq_score']) * previous_sessions
+                  - float(replaced_history.get('session_eq_score') or 0.0)
+                  + sum(tail_session_eqs))
+        average_eq = eq_sum / total_sessions
+        cumulative_error_counts = {
+            k: int(metrics.get(k) or 0) - int(replaced_history.get(k) or 0) + tail_error_counts[k]
+            for k in COUNTED_ERROR_TYPES.keys()
+        }
+
+        # --- Penyimpanan ke Database ---
+        # Agregat inkremental hanya benar jika sesi terakhir di history ikut tersimpan;
+        # jika history gagal, eq_metrics tidak ditulis agar state tersimpan tetap konsisten
+        if not supabase_service.upsert_eq_metrics_history_batch(history_records):
+            logger.error(f"Failed to save EQ history for user {user_id}. Skipping incremental eq_metrics update.")
+            return None
+
         metrics_data = {
             'user_id': user_id,
             'average_eq_score': float(average_eq),
-            'total_sessions_analyzed': len(all_session_eqs), # Jumlah sesi yang berhasil dihitung EQnya
-            'last_calculated_at': datetime.now(timezone.utc).isoformat(),
-            # Tambahkan 6 kolom error counts total KESELURUHAN
+            'total_sessions_analyzed': total_sessions,
+            'last_calculated_at': now_iso,
             **cumulative_error_counts
         }
-
-        # Simpan/update metrik agregat
-        try:
-             supabase_service.upsert_eq_metrics(metrics_data)
-        except Exception as db_metrics_err:
-             logger.error(f"Database error upserting metrics for user {user_id}: {db_metrics_err}", exc_info=True)
-             # Mungkin kembalikan None jika penyimpanan gagal?
+        if not supabase_service.upsert_eq_metrics(metrics_data):
+             logger.error(f"Failed to save EQ metrics for user {user_id}.")
              return None
 
-        logger.info(f"Successfully processed EQ and error counts for user {user_id}. Average EQ: {average_eq:.4f}")
-        return float(average_eq) # Kembalikan skor rata-rata
+        logger.info(f"Incrementally updated EQ for user {user_id} ({len(sessions)} tail sessions). Average EQ: {average_eq:.4f}")
+        return float(average_eq)
 
     except Exception as e:
-        logger.error(f"General error processing EQ for user {user_id}: {e}", exc_info=True)
-        return None # Kembalikan None jika ada error tak terduga
+        logger.error(f"General error incrementally processing EQ for user {user_id}: {e}", exc_info=True)
+        return None
+
+
+def _iter_completed_bounded(executor: ThreadPoolExecutor, fn, items: Iterable, max_in_flight: int):
+    """
+    Seperti executor.map, tetapi 'items' dibaca secara malas dan maksimal 'max_in_flight'
+    tugas aktif sekaligus. Menghasilkan (item, future) sesuai urutan selesai.
+    """
+    in_flight = {}
+    for item in items:
+        in_flight[executor.submit(fn, item)] = item
+        if len(in_flight) >= max_in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield in_flight.pop(future), future
+    for future in as_completed(in_flight):
+        yield in_flight[future], future
+
+
+def _flush_historical_batch(history_records: List[Dict], metrics_records: List[Dict], current_session_starts: Dict[str, List[str]]):
+    """
+    Menulis hasil kalkulasi historis banyak user sekaligus: upsert history, prune sesi yang sudah tidak ada, upsert eq_metrics.
+    Melempar RuntimeError jika penulisan gagal, agar kalkulasi berhenti alih-alih melanjutkan dengan data tidak konsisten.
+    Kunci user dalam batch dipegang selama penulisan, sehingga /classify yang berjalan bersamaan melihat
+    state lama atau state baru secara utuh (tidak pernah campuran keduanya).
+    """
+    with ExitStack() as stack:
+        for user_id in sorted(current_session_starts):
+            stack.enter_context(_user_lock(user_id))
+        if not supabase_service.upsert_eq_metrics_history_batch(history_records):
+            raise RuntimeError(f"Failed to save EQ history for {len(current_session_starts)} users.")
+        _prune_stale_history(current_session_starts)
+        if not supabase_service.upsert_eq_metrics_batch(metrics_records):
+            raise RuntimeError(f"Failed to save EQ metrics for {len(metrics_records)} users.")
 
 
-def calculate_historical_eq_all_users():
-    """Menghitung ulang EQ untuk semua pengguna berdasarkan data feedback."""
+def calculate_historical_eq_all_users() -> Optional[List[Dict]]:
+    """
+    Menghitung ulang EQ untuk semua pengguna berdasarkan data feedback.
+    Mengembalikan baris eq_metrics yang berhasil ditulis (untuk retraining tanpa membaca ulang tabel),
+    atau None jika kalkulasi berhenti karena error.
+    """
     logger.info("Starting historical EQ and error counts calculation for all users...")
     try:
-        unique_users = supabase_service.fetch_unique_users_from_feedback()
-        if not unique_users:
-            logger.warning("No users found in feedback table.")
-            return
-
-        total_users = len(unique_users)
-        logger.info(f"Found {total_users} unique users to process.")
+        # Feedback semua user dibaca dari satu query berhalaman dan dikelompokkan per user secara streaming
+        # (bukan satu query per user), sehingga tidak dimuat seluruhnya ke memori
+        feedback_by_user = supabase_service.iter_feedback_by_user()
 
         processed_count = 0
         success_count = 0
         fail_count = 0
-        for user_id in unique_users:
-            logger.info(f"Processing historical data for user {user_id} ({processed_count+1}/{total_users})...")
-            result = process_user_eq(user_id) # Fungsi ini akan mengurus penyimpanan
-            if result is not None:
-                 success_count += 1
-            else:
-                 fail_count +=1
-                 logger.warning(f"Failed to process historical EQ for user {user_id}.")
-
-            processed_count += 1
-            # Log progress sesekali
-            if processed_count % 50 == 0 or processed_count == total_users:
-                logger.info(f"Progress: Processed {processed_count}/{total_users} users (Success: {success_count}, Fail: {fail_count}).")
+        # Hasil user dikumpulkan lalu ditulis per HISTORICAL_FLUSH_USERS user (bukan 3 request per user)
+        pending_history, pending_metrics, pending_prunes = [], [], {}
+        written_metrics = []
+        # Proses beberapa user sekaligus agar latensi jaringan antar user saling tumpang tindih
+        with ThreadPoolExecutor(max_workers=HISTORICAL_MAX_WORKERS) as executor:
+            completed = _iter_completed_bounded(
+                executor, lambda item: _compute_user_eq(*item), feedback_by_user, HISTORICAL_MAX_WORKERS * 2
+            )
+            for (user_id, _), future in completed:
+                try:
+                    result = future.result()
+                except Exception as user_err:
+                    logger.error(f"Unexpected error processing user {user_id}: {user_err}", exc_info=True)
+                    result = None
+                if result is not None:
+                     history_records, metrics_data = result
+                     pending_history.extend(history_records)
+                     pending_metrics.append(metrics_data)
+                     pending_prunes[user_id] = [record['session_start_time'] for record in history_records]
+                     success_count += 1
+                else:
+                     fail_count +=1
+                     logger.warning(f"Failed to process historical EQ for user {user_id}.")
+
+                if len(pending_metrics) >= HISTORICAL_FLUSH_USERS:
+                    _flush_historical_batch(pending_history, pending_metrics, pending_prunes)
+                    written_metrics.extend(pending_metrics)
+                    pending_history, pending_metrics, pending_prunes = [], [], {}
+
+                processed_count += 1
+                # Log progress sesekali
+                if processed_count % 50 == 0:
+                    logger.info(f"Progress: Processed {processed_count} users (Success: {success_count}, Fail: {fail_count}).")
+
+        # Tulis sisa hasil yang belum mencapai satu batch penuh
+        _flush_historical_batch(pending_history, pending_metrics, pending_prunes)
+        written_metrics.extend(pending_metrics)
+
+        if processed_count == 0:
+            logger.warning("No users found in feedback table.")
+            return written_metrics
 
         logger.info(f"✅ Historical EQ and error counts calculation finished. Processed: {processed_count}, Success: {success_count}, Fail: {fail_count}.")
+        return written_metrics
 
     except Exception as e:
-        logger.error(f"❌ Unhandled error during historical EQ calculation: {e}", exc_info=True)
\ No newline at end of file
+        logger.error(f"❌ Unhandled error during historical EQ calculation: {e}", exc_info=True)
+        return None
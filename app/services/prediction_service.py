@@ -8,7 +8,9 @@ from sklearn.preprocessing import StandardScaler
 import logging
 from . import supabase_service # Impor supabase service
 from datetime import datetime, timezone
-from typing import List, Tuple
+import threading
+from functools import lru_cache
+from typing import List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -18,42 +20,84 @@ scaler = None
 kmeans = None
 perf_map = None # Map dari cluster index (0, 1, 2) ke performa ('HIGH', 'MEDIUM', 'LOW')
 cluster_label_map = None # Map dari cluster index (0, 1, 2) ke label (1, 2, 3)
+# Melindungi pergantian komponen model di atas dan cache prediksi: retraining berjalan di thread
+# terpisah dari /classify, jadi prediksi tidak boleh membaca (atau meng-cache) model yang setengah diganti
+_model_lock = threading.RLock()
 
 # == Nama fitur BARU untuk clustering ==
 feature_cols = ['average_eq_score'] # Fitur utama adalah rata-rata EQ
 
+# Kolom eq_metrics yang dipakai retraining (diambil dari database dan dijadikan DataFrame dengan urutan ini)
+RETRAIN_COLUMNS = ['user_id', *feature_cols, 'total_sessions_analyzed']
+# Kolom numerik di atas; dipaksa float64 agar nilai null tidak membuat kolom bertipe object
+RETRAIN_NUMERIC_COLUMNS = [*feature_cols, 'total_sessions_analyzed']
+
+# Presisi pembulatan average_eq untuk cache prediksi (cluster 1-D praktis konstan per potongan)
+PREDICTION_CACHE_DECIMALS = 4
+
 def load_model():
     """Memuat model EQ K=3 dari file .pkl atau menginisialisasi model baru jika tidak ada."""
-    global scaler, kmeans, perf_map, cluster_label_map
     try:
-        scaler, kmeans, perf_map, cluster_label_map = joblib.load(MODEL_PATH)
+        new_scaler, new_kmeans, new_perf_map, new_cluster_label_map = joblib.load(MODEL_PATH)
         logger.info(f"EQ Model (K=3) loaded from {MODEL_PATH}")
-        if kmeans is not None and kmeans.n_clusters != 3:
-             logger.warning(f"Loaded model has {kmeans.n_clusters} clusters, expected 3. Re-initializing.")
+        if new_kmeans is not None and new_kmeans.n_clusters != 3:
+             logger.warning(f"Loaded model has {new_kmeans.n_clusters} clusters, expected 3. Re-initializing.")
              raise FileNotFoundError("Model K mismatch")
-        if perf_map is None or cluster_label_map is None:
+        if new_perf_map is None or new_cluster_label_map is None:
              logger.warning("Loaded model missing perf_map or cluster_label_map. Re-initializing.")
              raise FileNotFoundError("Missing maps")
     except (FileNotFoundError, ValueError, EOFError, TypeError, AttributeError) as e:
         logger.warning(f"{MODEL_PATH} not found or invalid ({e}). Initializing a new K=3 EQ model.")
-        scaler = StandardScaler()
-        kmeans = KMeans(n_clusters=3, random_state=42, n_init='auto')
-        perf_map = {0: 'HIGH', 1: 'MEDIUM', 2: 'LOW'}
-        cluster_label_map = {0: 1, 1: 2, 2: 3}
+        new_scaler, new_kmeans, new_perf_map, new_cluster_label_map = _default_model()
     except Exception as e:
         logger.error(f"Unexpected error loading EQ model: {e}. Initializing a new one.", exc_info=True)
-        scaler = StandardScaler()
-        kmeans = KMeans(n_clusters=3, random_state=42, n_init='auto')
-        perf_map = {0: 'HIGH', 1: 'MEDIUM', 2: 'LOW'}
-        cluster_label_map = {0: 1, 1: 2, 2: 3}
+        new_scaler, new_kmeans, new_perf_map, new_cluster_label_map = _default_model()
+    _set_model(new_scaler, new_kmeans, new_perf_map, new_cluster_label_map)
+
+
+def _default_model():
+    """Komponen model K=3 baru (belum dilatih) dengan mapping default."""
+    return (
+        StandardScaler(),
+        KMeans(n_clusters=3, random_state=42, n_init='auto'),
+        {0: 'HIGH', 1: 'MEDIUM', 2: 'LOW'},
+        {0: 1, 1: 2, 2: 3},
+    )
+
+
+def _set_model(new_scaler, new_kmeans, new_perf_map, new_cluster_label_map):
+    """Mengganti semua komponen model sekaligus dan mengosongkan cache prediksi, di bawah _model_lock."""
+    global scaler, kmeans, perf_map, cluster_label_map
+    with _model_lock:
+        scaler, kmeans, perf_map, cluster_label_map = new_scaler, new_kmeans, new_perf_map, new_cluster_label_map
+        # Model berganti: hasil prediksi yang di-cache tidak berlaku lagi
+        _predict_performance_cached.cache_clear()
 
 
 def predict_performance(average_eq_score: float) -> Tuple[str, int]:
     """
     Melakukan prediksi cluster dan performa berdasarkan average_eq_score.
     Mengembalikan (performance_label, cluster_label_1_2_3).
+    Hasil di-cache per average_eq yang dibulatkan ke PREDICTION_CACHE_DECIMALS desimal;
+    prediksi default (model belum siap / error) tidak ikut di-cache.
+    """
+    rounded_score = round(float(average_eq_score), PREDICTION_CACHE_DECIMALS)
+    with _model_lock:
+        try:
+            return _predict_performance_cached(rounded_score)
+        except RuntimeError:
+            raise # Model tidak bisa dimuat sama sekali
+        except Exception as e:
+            logger.warning(f"Prediction unavailable ({e}). Returning default prediction.")
+            return 'MEDIUM', 2
+
+
+@lru_cache(maxsize=2048)
+def _predict_performance_cached(average_eq_score: float) -> Tuple[str, int]:
+    """
+    Prediksi sebenarnya; dipanggil di bawah _model_lock dan cache dikosongkan setiap kali model diganti.
+    Melempar exception (bukan mengembalikan default) agar hasil gagal tidak tersimpan di cache.
     """
-    global scaler, kmeans, perf_map, cluster_label_map
     if scaler is None or kmeans is None or perf_map is None or cluster_label_map is None:
          logger.error("EQ Model (K=3) components are not loaded properly. Loading default...")
          load_model()
@@ -61,37 +105,74 @@ def predict_performance(average_eq_score: float) -> Tuple[str, int]:
               raise RuntimeError("EQ Model (K=3) cannot be loaded. Cannot perform prediction.")
 
     if not hasattr(scaler, 'mean_') or scaler.mean_ is None:
-        logger.warning("Scaler has not been fitted. Returning default prediction.")
-        return 'MEDIUM', 2
+        raise ValueError("Scaler has not been fitted")
 
     if not hasattr(kmeans, 'cluster_centers_') or kmeans.cluster_centers_ is None:
-        logger.warning("KMeans has not been fitted. Returning default prediction.")
-        return 'MEDIUM', 2
+        raise ValueError("KMeans has not been fitted")
 
-    try:
-        X_new = np.array([[average_eq_score]])
-        X_scaled = scaler.transform(X_new)
-        cluster_index = kmeans.predict(X_scaled)[0] # Hasilnya 0, 1, atau 2
-        performance = perf_map.get(int(cluster_index), 'MEDIUM')
-        cluster_label = cluster_label_map.get(int(cluster_index), 2) # Hasilnya 1, 2, atau 3
-        return performance, int(cluster_label)
-    except Exception as e:
-         logger.error(f"Error during prediction: {e}", exc_info=True)
-         return 'MEDIUM', 2
+    # Satu fitur (average_eq_score): standardisasi & pencarian center terdekat dihitung langsung,
+    # setara scaler.transform + kmeans.predict tanpa overhead validasi input sklearn per request
+    z = (average_eq_score - scaler.mean_[0]) / scaler.scale_[0]
+    cluster_index = np.argmin(np.abs(kmeans.cluster_centers_[:, 0] - z)) # Hasilnya 0, 1, atau 2
+    performance = perf_map.get(int(cluster_index), 'MEDIUM')
+    cluster_label = cluster_label_map.get(int(cluster_index), 2) # Hasilnya 1, 2, atau 3
+    return performance, int(cluster_label)
 
 
-def retrain_model():
-    """Fungsi untuk melatih ulang model KMeans (K=3) dengan data EQ terbaru."""
+def _diff_history_against_final_state(history_records: List[dict], df: pd.DataFrame) -> Tuple[List[dict], int]:
+    """
+    Membandingkan cluster/performance tiap record eq_metrics_history dengan state akhir user
+    (kolom ClusterLabel & Performance di df) lewat satu merge, bukan lookup dict per record.
+    Mengembalikan (update {id, cluster, performance} untuk record yang berubah, jumlah record yang dilewati).
+    """
+    # dtype=object: nilai asli (int/None/str) dipertahankan, sehingga perbandingan sama seperti di Python
+    hist_df = pd.DataFrame(history_records, columns=['id', 'user_id', 'cluster', 'performance'], dtype=object)
+    final_df = df[['user_id', 'ClusterLabel', 'Performance']].rename(
+        columns={'ClusterLabel': 'final_cluster', 'Performance': 'final_performance'}
+    )
+    merged = hist_df.merge(final_df, on='user_id', how='left', indicator=True)
+
+    has_id = merged['id'].notna() & merged['id'].astype(bool)
+    known = (merged['_merge'] == 'both') & has_id
+    unknown_count = int((~known).sum())
+    if unknown_count:
+        logger.warning(f"Skipping {unknown_count} history record updates: user not in final state or record ID missing.")
+
+    changed = known & (
+        (merged['cluster'] != merged['final_cluster']) | (merged['performance'] != merged['final_performance'])
+    )
+    changed_rows = merged.loc[changed]
+    # int(): merge left membuat kolom cluster jadi float jika ada user yang tidak dikenal
+    updates_history = [
+        {'id': record_id, 'cluster': int(cluster), 'performance': performance}
+        for record_id, cluster, performance in zip(
+            changed_rows['id'].tolist(), changed_rows['final_cluster'].tolist(), changed_rows['final_performance'].tolist()
+        )
+    ]
+    return updates_history, len(merged) - len(updates_history)
+
+
+def retrain_model(metrics_records: Optional[List[dict]] = None):
+    """
+    Fungsi untuk melatih ulang model KMeans (K=3) dengan data EQ terbaru.
+    Jika 'metrics_records' (baris eq_metrics yang sudah ada di memori) diberikan, data dipakai langsung
+    tanpa mengambil ulang eq_metrics dari database; hanya user di baris tersebut yang dilatih dan di-relabel.
+    """
     logger.info("Starting EQ model (K=3) retraining...")
-    global scaler, kmeans, perf_map, cluster_label_map
+    # Model baru dibangun di variabel lokal dan baru dipasang lewat _set_model setelah lengkap;
+    # jika retraining gagal di tengah jalan, model lama tetap dipakai
 
-    # 1. Ambil data EQ terbaru
-    data = supabase_service.fetch_all_eq_metrics()
+    # 1. Ambil data EQ terbaru (kecuali sudah diberikan oleh pemanggil)
+    if metrics_records is not None:
+        data = metrics_records
+    else:
+        data = supabase_service.fetch_all_eq_metrics(columns=", ".join(RETRAIN_COLUMNS))
     if not data or len(data) < 3:
         logger.warning(f"Not enough data in eq_metrics ({len(data)} records, need >= 3) for K=3. Aborting.")
         return
 
-    df = pd.DataFrame(data)
+    df = pd.DataFrame.from_records(data, columns=RETRAIN_COLUMNS)
+    df[RETRAIN_NUMERIC_COLUMNS] = df[RETRAIN_NUMERIC_COLUMNS].astype(np.float64)
     df = df.dropna(subset=feature_cols)
     df = df[df['total_sessions_analyzed'] > 0]
     if df.shape[0] < 3:
@@ -102,23 +183,29 @@ def retrain_model():
 
     # 2. Scaling
     try:
-        scaler = StandardScaler()
-        X_scaled = scaler.fit_transform(X_new)
+        new_scaler = StandardScaler()
+        X_scaled = new_scaler.fit_transform(X_new)
     except ValueError as e:
         logger.error(f"Error during scaling: {e}. Check data variance. Aborting.", exc_info=True)
         return
 
     # 3. Latih KMeans dengan K=3
-    kmeans = KMeans(n_clusters=3, random_state=42, n_init='auto')
+    new_kmeans = KMeans(n_clusters=3, random_state=42, n_init='auto')
     try:
-        df['ClusterIndex'] = kmeans.fit_predict(X_scaled) # Menghasilkan index 0, 1, 2
+        df['ClusterIndex'] = new_kmeans.fit_predict(X_scaled).astype(np.int8) # Menghasilkan index 0, 1, 2 (int8 cukup)
     except Exception as e:
         logger.error(f"Error during K-Means fitting (K=3): {e}", exc_info=True)
         return
 
     # 4. Tentukan mapping cluster index (0, 1, 2) -> performa & label (1, 2, 3)
+    cluster_indices = df['ClusterIndex'].to_numpy()
     try:
-        cluster_order = df.groupby('ClusterIndex')['average_eq_score'].mean().sort_values(ascending=True).index
+        # Rata-rata EQ per cluster lewat np.bincount (tanpa groupby); cluster kosong tidak diikutkan
+        cluster_sizes = np.bincount(cluster_indices, minlength=new_kmeans.n_clusters)
+        cluster_sums = np.bincount(cluster_indices, weights=df['average_eq_score'].to_numpy(), minlength=new_kmeans.n_clusters)
+        present_clusters = np.flatnonzero(cluster_sizes)
+        cluster_means = cluster_sums[present_clusters] / cluster_sizes[present_clusters]
+        cluster_order = present_clusters[np.argsort(cluster_means, kind='stable')]
     except Exception as e:
         logger.error(f"Error grouping cluster means: {e}. Aborting.", exc_info=True)
         return
@@ -126,48 +213,46 @@ def retrain_model():
     performance_labels = ['HIGH', 'MEDIUM', 'LOW']
     cluster_labels = [1, 2, 3]
 
-    perf_map = {}
-    cluster_label_map = {}
+    new_perf_map = {}
+    new_cluster_label_map = {}
     if len(cluster_order) == 3:
         for i, cluster_idx in enumerate(cluster_order):
-            perf_map[int(cluster_idx)] = performance_labels[i]
-            cluster_label_map[int(cluster_idx)] = cluster_labels[i]
-        logger.info(f"New performance map (Index -> Perf): {perf_map}")
-        logger.info(f"New cluster label map (Index -> Label 1-3): {cluster_label_map}")
+            new_perf_map[int(cluster_idx)] = performance_labels[i]
+            new_cluster_label_map[int(cluster_idx)] = cluster_labels[i]
+        logger.info(f"New performance map (Index -> Perf): {new_perf_map}")
+        logger.info(f"New cluster label map (Index -> Label 1-3): {new_cluster_label_map}")
     else:
         logger.error(f"KMeans did not produce 3 clusters (found {len(cluster_order)}). Aborting retraining.")
-        scaler, kmeans, perf_map, cluster_label_map = None, None, None, None
         return
 
-    df['Performance'] = df['ClusterIndex'].map(perf_map)
-    df['ClusterLabel'] = df['ClusterIndex'].map(cluster_label_map) # Label 1, 2, 3
+    # Pasang model baru (semua komponen sekaligus) untuk prediksi berikutnya
+    _set_model(new_scaler, new_kmeans, new_perf_map, new_cluster_label_map)
+
+    # Relabel lewat tabel lookup per cluster index (fancy indexing NumPy, tanpa lookup dict per baris)
+    perf_lookup = np.array([new_perf_map[i] for i in range(new_kmeans.n_clusters)], dtype=object)
+    label_lookup = np.array([new_cluster_label_map[i] for i in range(new_kmeans.n_clusters)], dtype=np.int8)
+    df['Performance'] = perf_lookup[cluster_indices]
+    df['ClusterLabel'] = label_lookup[cluster_indices] # Label 1, 2, 3
 
     # 5. Simpan model baru
     try:
-        joblib.dump((scaler, kmeans, perf_map, cluster_label_map), MODEL_PATH)
+        joblib.dump((new_scaler, new_kmeans, new_perf_map, new_cluster_label_map), MODEL_PATH)
         logger.info(f"EQ Model (K=3) successfully retrained and saved to {MODEL_PATH}.")
     except Exception as e:
         logger.error(f"Failed to save retrained EQ model (K=3): {e}", exc_info=True)
         return
 
     # 6. Siapkan data update untuk tabel eq_metrics
-    updates_metrics = []
     current_time_iso = datetime.now(timezone.utc).isoformat()
-    user_final_state = df.set_index('user_id')[['ClusterLabel', 'Performance']].to_dict('index')
-
-    for index, row in df.iterrows():
-        user_id = row['user_id']
-        cluster_label_val = row.get('ClusterLabel')
-        performance_val = row.get('Performance')
-        if pd.isna(cluster_label_val): cluster_label_val = None
-        if pd.isna(performance_val): performance_val = None
-
-        updates_metrics.append({
-            'user_id': user_id,
-            'cluster': int(cluster_label_val) if cluster_label_val is not None else None,
-            'performance': performance_val,
-            'last_calculated_at': current_time_iso
-        })
+
+    # Dibangun per kolom (tanpa iterrows); tolist() menghasilkan int/str Python yang bisa di-serialize ke JSON.
+    # ClusterLabel & Performance berasal dari lookup lengkap per cluster index, jadi tidak pernah kosong
+    updates_metrics = [
+        {'user_id': user_id, 'cluster': cluster, 'performance': performance, 'last_calculated_at': current_time_iso}
+        for user_id, cluster, performance in zip(
+            df['user_id'].tolist(), df['ClusterLabel'].tolist(), df['Performance'].tolist()
+        )
+    ]
 
     # 7. Update batch ke eq_metrics di Supabase
     if updates_metrics:
@@ -177,56 +262,10 @@ def retrain_model():
     # 8. Update eq_metrics_history
     # ---- MULAI BAGIAN UPDATE HISTORY ----
     logger.info("--- Starting eq_metrics_history update ---")
-    all_history_records = supabase_service.fetch_all_eq_metrics_history()
-    updates_history = []
+    all_history_records = supabase_service.fetch_all_eq_metrics_history(columns="id, user_id, cluster, performance")
     if all_history_records:
         logger.info(f"Fetched {len(all_history_records)} history records to potentially update.")
-        updated_count = 0
-        skipped_count = 0
-        for record in all_history_records:
-            user_id = record.get('user_id')
-            record_id = record.get('id')
-
-            # Debugging: Log user_id dan record_id
-            # logger.debug(f"Processing history record: ID={record_id}, User={user_id}")
-
-            if user_id in user_final_state and record_id:
-                 final_state = user_final_state[user_id]
-                 final_cluster_label = final_state.get('ClusterLabel') # Hasilnya 1, 2, atau 3
-                 final_performance = final_state.get('Performance') # Hasilnya 'HIGH', 'MEDIUM', 'LOW'
-
-                 # Konversi tipe data final state untuk perbandingan
-                 final_cluster_label_int = int(final_cluster_label) if final_cluster_label is not None else None
-
-                 # Ambil nilai history saat ini
-                 current_hist_cluster = record.get('cluster') # Bisa None atau int
-                 current_hist_performance = record.get('performance') # Bisa None atau string
-
-                 # Log nilai sebelum perbandingan
-                 # logger.debug(f"User {user_id} - History: Cls={current_hist_cluster}, Perf={current_hist_performance} | Final: Cls={final_cluster_label_int}, Perf={final_performance}")
-
-                 needs_update = False
-                 if current_hist_cluster != final_cluster_label_int:
-                      logger.debug(f"Cluster mismatch for hist_id {record_id} (User {user_id}): {current_hist_cluster} != {final_cluster_label_int}")
-                      needs_update = True
-                 if current_hist_performance != final_performance:
-                      logger.debug(f"Performance mismatch for hist_id {record_id} (User {user_id}): {current_hist_performance} != {final_performance}")
-                      needs_update = True
-
-                 if needs_update:
-                     updates_history.append({
-                         'id': record_id, # Kunci utama untuk update
-                         'cluster': final_cluster_label_int,
-                         'performance': final_performance
-                     })
-                     updated_count += 1
-                 else:
-                     skipped_count += 1
-                     # logger.debug(f"No update needed for history record ID={record_id}")
-
-            else:
-                 logger.warning(f"Skipping history record update: User {user_id} not in final state or record ID {record_id} missing.")
-                 skipped_count += 1
+        updates_history, skipped_count = _diff_history_against_final_state(all_history_records, df)
 
         logger.info(f"Prepared {len(updates_history)} updates for history table ({skipped_count} skipped).")
         # Lakukan batch update pada history berdasarkan ID
@@ -241,8 +280,7 @@ def retrain_model():
     # ---- AKHIR BAGIAN UPDATE HISTORY ----
 
 
-    # 9. Update metadata model
-    current_time_iso = datetime.now(timezone.utc).isoformat()
+    # 9. Update metadata model (memakai timestamp yang sama dengan update eq_metrics di langkah 6)
     try:
         metadata_payload = {
             "optimal_k": 3, # K=3
@@ -1,10 +1,12 @@
 # app/services/supabase_service.py
 import os
+from itertools import groupby
+from operator import itemgetter
 from supabase import create_client, Client
 from dotenv import load_dotenv
 import logging
 from datetime import datetime, timezone
-from typing import Optional, List, Dict
+from typing import Iterator, Optional, List, Dict, Tuple
 import re # Import re for fallback timezone parsing if needed
 
 load_dotenv()
@@ -17,11 +19,50 @@ if not supabase_url or not supabase_key:
     logger.error("Supabase URL and Key must be set in the .env file.")
     raise ValueError("Supabase credentials not found.")
 
+# Satu client untuk seluruh proses: client PostgREST (httpx) di dalamnya dibuat sekali dan
+# koneksinya (keep-alive) dipakai ulang oleh semua fungsi di modul ini, termasuk lintas thread.
+# Script lain sebaiknya memakai client ini, bukan membuat client baru.
 supabase: Client = create_client(supabase_url, supabase_key)
 
+# Maksimum baris per request tulis batch (PostgREST melambat/menolak payload yang terlalu besar)
+WRITE_BATCH_SIZE = 500
+
+# Kolom feedback yang dibutuhkan perhitungan EQ (kolom lain tidak diambil agar payload & dict per event kecil)
+EQ_FEEDBACK_COLUMNS = "error_snapshot, created_at"
+
+# Kolom urutan stabil untuk keyset pagination feedback ('id' sebagai pemutus seri created_at yang sama)
+FEEDBACK_KEYSET_COLUMNS = ("created_at", "id")
+FEEDBACK_BY_USER_KEYSET_COLUMNS = ("user_id", *FEEDBACK_KEYSET_COLUMNS)
+
+# Maksimum user per request prune batch (filter dikirim lewat URL, jadi dijaga tetap pendek)
+PRUNE_BATCH_SIZE = 50
+
+
+def _chunked(records: List[Dict], size: int = WRITE_BATCH_SIZE):
+    """Memecah list record menjadi potongan berukuran maksimal 'size'."""
+    for i in range(0, len(records), size):
+        yield records[i:i + size]
+
+
+def _keyset_after(last_row: Dict, columns: Tuple[str, ...]) -> str:
+    """
+    Filter PostgREST 'or' untuk baris yang datang SESUDAH 'last_row' menurut urutan ascending 'columns'
+    (keyset pagination). Berbeda dengan offset, halaman berikutnya tidak bergeser saat ada insert baru.
+    """
+    conditions = []
+    for i, column in enumerate(columns):
+        same_prefix = [f'{c}.eq."{last_row[c]}"' for c in columns[:i]]
+        after = f'{column}.gt."{last_row[column]}"'
+        conditions.append(f"and({','.join(same_prefix + [after])})" if same_prefix else after)
+    return ",".join(conditions)
+
+
 # --- Fungsi Inti ---
 def save_raw_error_snapshot(user_id, project_id, error_snapshot, code_snapshot=None):
-    """Menyimpan error snapshot mentah ke tabel ai_automated_feedbacks."""
+    """
+    Menyimpan error snapshot mentah ke tabel ai_automated_feedbacks.
+    Mengembalikan payload yang disimpan (termasuk created_at) atau None jika gagal.
+    """
     try:
         payload = {
             "user_id": user_id,
@@ -32,112 +73,237 @@ def save_raw_error_snapshot(user_id, project_id, error_snapshot, code_snapshot=N
         }
         supabase.table("ai_automated_feedbacks").insert(payload).execute()
         logger.info(f"Saved raw error snapshot for user {user_id}.")
+        return payload
     except Exception as e:
         logger.error(f"Failed to save raw error snapshot for user {user_id}: {e}", exc_info=True)
+        return None
 
 
 # === Fungsi untuk EQ ===
 
-def fetch_all_feedback_for_user(user_id: str, batch_size: int = 1000) -> List[Dict]:
-    """Mengambil seluruh riwayat feedback (error snapshot & timestamp) untuk user tertentu."""
-    records = []
-    start = 0
+def iter_feedback_for_user(user_id: str, batch_size: int = 1000, since: Optional[str] = None) -> Iterator[Dict]:
+    """
+    Menghasilkan riwayat feedback (error snapshot & timestamp) user tertentu per halaman, urut (created_at, id).
+    Jika 'since' (ISO timestamp) diberikan, hanya feedback dengan created_at >= since yang diambil.
+    Halaman berikutnya baru diambil setelah halaman sebelumnya habis dikonsumsi (keyset pagination).
+    Jika pengambilan gagal di tengah jalan, exception diteruskan ke pemanggil
+    (riwayat yang terpotong akan menghasilkan EQ yang salah).
+    """
+    fetched = 0
+    last_row = None
     try:
         while True:
-            response = (
+            query = (
                 supabase
                 .table("ai_automated_feedbacks")
-                .select("user_id, project_id, error_snapshot, created_at")
+                .select(f"id, {EQ_FEEDBACK_COLUMNS}") # id dibutuhkan sebagai pemutus seri keyset
                 .eq("user_id", user_id)
+                .not_.is_("created_at", "null")
+            )
+            if since:
+                query = query.gte("created_at", since)
+            if last_row is not None:
+                query = query.or_(_keyset_after(last_row, FEEDBACK_KEYSET_COLUMNS))
+            response = (
+                query
                 .order("created_at", desc=False)
-                .range(start, start + batch_size - 1)
+                .order("id", desc=False)
+                .limit(batch_size)
                 .execute()
             )
             batch = response.data or []
-            records.extend(batch)
-            if not batch or len(batch) < batch_size:
+            fetched += len(batch)
+            yield from batch
+            if len(batch) < batch_size:
                 break
-            start += batch_size
-        logger.info(f"Fetched {len(records)} feedback events for user {user_id}.")
+            last_row = batch[-1]
+        logger.info(f"Fetched {fetched} feedback events for user {user_id}.")
     except Exception as e:
-        logger.error(f"Failed to fetch feedback history for user {user_id}: {e}", exc_info=True)
-    return records
+        logger.error(f"Failed to fetch feedback history for user {user_id} after {fetched} events: {e}")
+        raise
 
 
-def fetch_unique_users_from_feedback() -> List[str]:
-    """Mengambil daftar user_id unik dari tabel feedback menggunakan query biasa."""
-    logger.info("Fetching unique users from feedback (using improved fallback method)...")
-    all_user_ids = set()
-    start = 0
-    batch_size = 1000 # Ukuran batch bisa disesuaikan
-
-    try:
-        while True:
-            response = (
-                supabase.table("ai_automated_feedbacks")
-                .select("user_id")
-                .range(start, start + batch_size - 1)
-                .execute()
-            )
-            batch = response.data or []
+def _iter_feedback_rows_ordered(batch_size: int) -> Iterator[Dict]:
+    """
+    Menghasilkan seluruh baris feedback per halaman, urut (user_id, created_at, id).
+    Memakai keyset pagination: insert baru dari /classify selama proses berjalan tidak menggeser
+    halaman berikutnya (tidak ada baris yang terlewat atau terbaca dua kali), dan setiap halaman
+    dibaca lewat index, bukan melewati 'offset' baris terlebih dahulu.
+    """
+    last_row = None
+    while True:
+        query = (
+            supabase
+            .table("ai_automated_feedbacks")
+            .select(f"id, user_id, {EQ_FEEDBACK_COLUMNS}") # user_id untuk pengelompokan, id sebagai pemutus seri
+            .not_.is_("user_id", "null")
+            .not_.is_("created_at", "null")
+        )
+        if last_row is not None:
+            query = query.or_(_keyset_after(last_row, FEEDBACK_BY_USER_KEYSET_COLUMNS))
+        response = (
+            query
+            .order("user_id", desc=False)
+            .order("created_at", desc=False)
+            .order("id", desc=False)
+            .limit(batch_size)
+            .execute()
+        )
+        batch = response.data or []
+        yield from batch
+        if len(batch) < batch_size:
+            break
+        last_row = batch[-1]
 
-            if not batch:
-                break
 
-            for item in batch:
-                all_user_ids.add(item['user_id'])
+def iter_feedback_by_user(batch_size: int = 1000) -> Iterator[Tuple[str, List[Dict]]]:
+    """
+    Menghasilkan (user_id, feedback user tersebut) untuk semua user dari satu query berhalaman,
+    sebagai pengganti iter_feedback_for_user per user. Baris dikelompokkan secara streaming,
+    sehingga yang ditahan di memori hanya feedback satu user dan satu halaman.
+    Jika pengambilan gagal di tengah jalan, exception diteruskan ke pemanggil agar
+    kalkulasi tidak dilaporkan selesai dengan sebagian user terlewat.
+    """
+    found = 0
+    try:
+        for user_id, rows in groupby(_iter_feedback_rows_ordered(batch_size), key=itemgetter('user_id')):
+            found += 1
+            yield user_id, list(rows)
+        logger.info(f"Finished streaming feedback. Found {found} unique users.")
+    except Exception as e:
+        logger.error(f"Failed to stream feedback by user after {found} users: {e}")
+        raise
 
-            if len(batch) < batch_size:
-                 break
 
-            start += batch_size
-            logger.debug(f"Fetched up to record {start}, found {len(all_user_ids)} unique users so far...")
+def fetch_feedback_times_since(user_id: str, since: str, limit: int = 2) -> List[Dict]:
+    """Mengambil created_at feedback user yang lebih baru dari 'since' (maksimal 'limit' baris, paling awal dulu)."""
+    try:
+        response = (
+            supabase
+            .table("ai_automated_feedbacks")
+            .select("created_at")
+            .eq("user_id", user_id)
+            .gt("created_at", since)
+            .order("created_at", desc=False)
+            .limit(limit)
+            .execute()
+        )
+        return response.data or []
+    except Exception as e:
+        logger.error(f"Failed to fetch recent feedback times for user {user_id}: {e}", exc_info=True)
+        return []
 
-        user_list = list(all_user_ids)
-        logger.info(f"Finished fetching. Found {len(user_list)} unique users.")
-        return user_list
 
+def upsert_eq_metrics_history_batch(history_records: List[Dict], on_conflict: str = "user_id,session_start_time") -> bool:
+    """
+    Menyimpan batch record history EQ dengan upsert.
+    Record dengan kunci 'on_conflict' yang sama akan ditimpa, bukan diduplikasi
+    (membutuhkan unique constraint dari migrations/001_eq_metrics_history_unique_session.sql).
+    Mengembalikan True jika semua record tersimpan, False jika ada yang gagal.
+    """
+    if not history_records: return True
+    try:
+        for chunk in _chunked(history_records):
+            supabase.table("eq_metrics_history").upsert(chunk, on_conflict=on_conflict).execute()
+        user_id_sample = history_records[0].get('user_id', 'unknown')
+        logger.info(f"Upserted {len(history_records)} EQ history records (sample user: {user_id_sample}).")
+        return True
     except Exception as e:
-        logger.error(f"Failed to fetch unique users using fallback: {e}", exc_info=True)
-        return []
+        if getattr(e, 'code', None) == '42P10':
+            logger.error(
+                f"eq_metrics_history has no unique constraint on ({on_conflict}); every EQ history upsert will fail. "
+                "Run migrations/001_eq_metrics_history_unique_session.sql."
+            )
+        logger.error(f"Failed to upsert EQ history batch: {e}", exc_info=True)
+        return False
 
 
-def delete_eq_metrics_history(user_id: str):
-    """Menghapus semua history EQ untuk user tertentu."""
+def fetch_eq_metrics_history_sessions(user_ids: List[str], batch_size: int = 1000) -> List[Dict]:
+    """Mengambil (id, user_id, session_start_time) seluruh record eq_metrics_history milik user-user ini."""
+    records = []
     try:
-        supabase.table("eq_metrics_history").delete().eq("user_id", user_id).execute()
-        logger.debug(f"Deleted old EQ history for user {user_id}.")
+        for user_chunk in _chunked(user_ids, PRUNE_BATCH_SIZE):
+            start = 0
+            while True:
+                response = (
+                    supabase.table("eq_metrics_history")
+                    .select("id, user_id, session_start_time")
+                    .in_("user_id", user_chunk)
+                    .order("id", desc=False)
+                    .range(start, start + batch_size - 1)
+                    .execute()
+                )
+                batch = response.data or []
+                records.extend(batch)
+                if len(batch) < batch_size:
+                    break
+                start += batch_size
     except Exception as e:
-        logger.error(f"Failed to delete EQ history for user {user_id}: {e}", exc_info=True)
+        logger.error(f"Failed to fetch EQ history sessions for {len(user_ids)} users: {e}", exc_info=True)
+        return []
+    return records
 
 
-def insert_eq_metrics_history_batch(history_records: List[Dict]):
-    """Menyimpan batch record history EQ."""
-    if not history_records: return
+def delete_eq_metrics_history_by_ids(record_ids: List[int]):
+    """Menghapus record eq_metrics_history berdasarkan 'id' (dipecah per WRITE_BATCH_SIZE)."""
+    if not record_ids: return
     try:
-        supabase.table("eq_metrics_history").insert(history_records).execute()
-        user_id_sample = history_records[0].get('user_id', 'unknown')
-        logger.info(f"Inserted {len(history_records)} EQ history records (sample user: {user_id_sample}).")
+        for chunk in _chunked(record_ids):
+            supabase.table("eq_metrics_history").delete().in_("id", chunk).execute()
+        logger.debug(f"Deleted {len(record_ids)} stale EQ history records.")
     except Exception as e:
-        logger.error(f"Failed to insert EQ history batch: {e}", exc_info=True)
+        logger.error(f"Failed to delete stale EQ history records: {e}", exc_info=True)
 
 
-def upsert_eq_metrics(metrics_data: Dict):
-    """Melakukan upsert (insert atau update) pada tabel eq_metrics."""
+def upsert_eq_metrics(metrics_data: Dict) -> bool:
+    """Melakukan upsert (insert atau update) pada tabel eq_metrics. Mengembalikan True jika berhasil."""
     try:
         supabase.table("eq_metrics").upsert(metrics_data).execute()
         logger.info(f"Upserted EQ metrics for user {metrics_data.get('user_id', 'N/A')}.")
+        return True
     except Exception as e:
         user_id = metrics_data.get('user_id', 'N/A')
         logger.error(f"Failed to upsert EQ metrics for user {user_id}: {e}", exc_info=True)
+        return False
+
+
+def upsert_eq_metrics_batch(metrics_records: List[Dict]) -> bool:
+    """
+    Melakukan upsert banyak baris eq_metrics sekaligus (dipecah per WRITE_BATCH_SIZE).
+    Mengembalikan True jika semua baris tersimpan, False jika ada yang gagal.
+    """
+    if not metrics_records: return True
+    try:
+        for chunk in _chunked(metrics_records):
+            supabase.table("eq_metrics").upsert(chunk).execute()
+        logger.info(f"Upserted EQ metrics for {len(metrics_records)} users.")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to upsert EQ metrics batch: {e}", exc_info=True)
+        return False
 
 
-def fetch_all_eq_metrics() -> List[Dict]:
-    """Mengambil semua data dari tabel eq_metrics untuk retraining."""
+def fetch_all_eq_metrics(columns: str = "*", batch_size: int = 1000) -> List[Dict]:
+    """
+    Mengambil semua data dari tabel eq_metrics untuk retraining.
+    'columns' membatasi kolom yang diambil; data diambil per halaman agar tidak terpotong batas baris PostgREST.
+    """
     records = []
+    start = 0
     try:
-        response = supabase.table("eq_metrics").select("*").execute()
-        records = response.data or []
+        while True:
+            # Urutan tetap (user_id) wajib untuk paging: tanpa itu Postgres bisa mengulang/melewati baris antar halaman
+            response = (
+                supabase.table("eq_metrics").select(columns)
+                .order("user_id", desc=False)
+                .range(start, start + batch_size - 1)
+                .execute()
+            )
+            batch = response.data or []
+            records.extend(batch)
+            if not batch or len(batch) < batch_size:
+                break
+            start += batch_size
         logger.info(f"Fetched {len(records)} records from eq_metrics.")
     except Exception as e:
         logger.error(f"Failed to fetch data from eq_metrics: {e}", exc_info=True)
@@ -156,24 +322,58 @@ def get_user_average_eq(user_id: str) -> Optional[float]:
     return avg_eq
 
 
+def get_user_eq_metrics(user_id: str) -> Optional[Dict]:
+    """Mengambil baris eq_metrics milik user (atau None jika belum ada)."""
+    try:
+        response = supabase.table("eq_metrics").select("*").eq("user_id", user_id).limit(1).execute()
+        return response.data[0] if response.data else None
+    except Exception as e:
+        logger.error(f"Failed to fetch EQ metrics for user {user_id}: {e}", exc_info=True)
+        return None
+
+
+def fetch_latest_eq_metrics_history(user_id: str) -> Optional[Dict]:
+    """Mengambil record eq_metrics_history dengan sesi paling akhir milik user (atau None)."""
+    try:
+        response = (
+            supabase.table("eq_metrics_history")
+            .select("*")
+            .eq("user_id", user_id)
+            .order("session_start_time", desc=True)
+            .limit(1)
+            .execute()
+        )
+        return response.data[0] if response.data else None
+    except Exception as e:
+        logger.error(f"Failed to fetch latest EQ history for user {user_id}: {e}", exc_info=True)
+        return None
+
+
 def update_eq_metrics_batch(updates: list):
     """Melakukan batch update pada tabel eq_metrics (untuk cluster/performance)."""
     if not updates: return
     try:
-        supabase.table("eq_metrics").upsert(updates).execute()
+        for chunk in _chunked(updates):
+            supabase.table("eq_metrics").upsert(chunk).execute()
         logger.info(f"Successfully batch updated {len(updates)} eq_metrics records.")
     except Exception as e:
         logger.error(f"Failed to batch update eq_metrics: {e}", exc_info=True)
 
 
-def fetch_all_eq_metrics_history() -> List[Dict]:
-    """Mengambil semua data dari tabel eq_metrics_history."""
+def fetch_all_eq_metrics_history(columns: str = "*") -> List[Dict]:
+    """Mengambil semua data dari tabel eq_metrics_history ('columns' membatasi kolom yang diambil)."""
     records = []
     start = 0
     batch_size = 2000 # Sesuaikan ukuran batch
     try:
         while True:
-            response = supabase.table("eq_metrics_history").select("*").range(start, start + batch_size - 1).execute()
+            # Urutan tetap (id) wajib untuk paging: tanpa itu Postgres bisa mengulang/melewati baris antar halaman
+            response = (
+                supabase.table("eq_metrics_history").select(columns)
+                .order("id", desc=False)
+                .range(start, start + batch_size - 1)
+                .execute()
+            )
             batch = response.data or []
             records.extend(batch)
             if not batch or len(batch) < batch_size:
@@ -195,7 +395,8 @@ def update_eq_metrics_history_batch(updates: List[Dict]):
     try:
         # Upsert berdasarkan primary key 'id' akan melakukan update
         # Pastikan setiap dict di 'updates' memiliki key 'id'
-        supabase.table("eq_metrics_history").upsert(updates).execute()
+        for chunk in _chunked(updates):
+            supabase.table("eq_metrics_history").upsert(chunk).execute()
         logger.info(f"Successfully batch updated {len(updates)} eq_metrics_history records.")
     except Exception as e:
         logger.error(f"Failed to batch update eq_metrics_history: {e}", exc_info=True)
@@ -222,29 +423,18 @@ def final_prediction_update(user_id: str, cluster_label: int, performance: str,
     logger.info(f"Updated primary metrics for user {user_id}.")
 
     # 2. Update eq_metrics_history (semua record user ini, termasuk yang baru di-insert)
-    history_records_to_update = []
+    # Satu PATCH terfilter user_id, bukan ambil semua ID lalu upsert per record (dua round trip)
     try:
-        # Ambil semua ID history record user ini
         response = (
             supabase.table("eq_metrics_history")
-            .select("id")
+            .update({'cluster': cluster_label, 'performance': performance})
             .eq("user_id", user_id)
             .execute()
         )
-        # Siapkan payload update untuk setiap ID history
-        for record in response.data or []:
-            history_records_to_update.append({
-                'id': record['id'],
-                'user_id': user_id, # Penting agar upsert tidak melanggar not-null
-                'cluster': cluster_label,
-                'performance': performance
-            })
-
-        if history_records_to_update:
-            # Gunakan fungsi update history batch yang sudah Anda buat
-            supabase.table("eq_metrics_history").upsert(history_records_to_update).execute()
-            logger.info(f"Updated {len(history_records_to_update)} history records for user {user_id} with cluster {cluster_label}.")
-        
+        updated_count = len(response.data or [])
+        if updated_count:
+            logger.info(f"Updated {updated_count} history records for user {user_id} with cluster {cluster_label}.")
+
     except Exception as e:
         logger.error(f"Failed to update history records for user {user_id} during prediction: {e}", exc_info=True)
 
@@ -20,9 +20,18 @@ if not supabase_url or not supabase_key:
     exit()
 
 # Script ini hanya memanggil fungsi kalkulasi historis dari eq_service
-if __name__ == "__main__":
+def run_initial_eq():
+    """
+    Menghitung ulang EQ semua pengguna. Mengembalikan baris eq_metrics yang ditulis
+    (dipakai migrate_metrics.py untuk retraining), atau None jika kalkulasi gagal.
+    """
     logging.info("Starting initial calculation of Error Quotient for all users...")
     # Panggil fungsi yang menghitung ulang EQ untuk semua pengguna
-    eq_service.calculate_historical_eq_all_users()
+    written_metrics = eq_service.calculate_historical_eq_all_users()
     logging.info("Initial EQ calculation process completed.")
-    logging.info("Please check the 'eq_metrics' and 'eq_metrics_history' tables in your database.")
\ No newline at end of file
+    logging.info("Please check the 'eq_metrics' and 'eq_metrics_history' tables in your database.")
+    return written_metrics
+
+
+if __name__ == "__main__":
+    run_initial_eq()
\ No newline at end of file
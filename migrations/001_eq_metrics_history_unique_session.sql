@@ -0,0 +1,13 @@
+-- Upsert eq_metrics_history memakai ON CONFLICT (user_id, session_start_time), dan pembersihan
+-- sesi lama mengandalkan satu record per sesi. Jalankan sekali di SQL editor Supabase sebelum deploy.
+
+-- 1. Hapus duplikat sesi yang sudah ada (simpan record dengan id terbesar)
+DELETE FROM eq_metrics_history a
+USING eq_metrics_history b
+WHERE a.user_id = b.user_id
+  AND a.session_start_time = b.session_start_time
+  AND a.id < b.id;
+
+-- 2. Tambahkan unique constraint yang dibutuhkan upsert
+ALTER TABLE eq_metrics_history
+  ADD CONSTRAINT eq_metrics_history_user_session_key UNIQUE (user_id, session_start_time);
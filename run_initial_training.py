@@ -14,16 +14,17 @@ if not supabase_url or not supabase_key:
     logging.error("Pastikan SUPABASE_URL dan SUPABASE_KEY ada di file .env")
     exit()
 
-def run_training():
+def run_training(metrics_records=None):
     """
     Memuat model dan menjalankan fungsi retraining EQ secara manual.
     Pastikan data EQ awal sudah dihitung sebelumnya.
+    'metrics_records' diteruskan ke retrain_model (None: seluruh eq_metrics dibaca dari database).
     """
     print("Memuat resources model EQ...")
     try:
         load_model() # Inisialisasi variabel global yang dibutuhkan
         print("Memulai proses training awal model EQ...")
-        retrain_model()
+        retrain_model(metrics_records)
         print("Proses training awal model EQ selesai.")
         print("Periksa tabel 'eq_metrics' dan 'model_metadata' di database Anda.")
     except Exception as e:
@@ -0,0 +1,197 @@
+# tests/test_eq_incremental.py
+"""
+Memastikan process_user_eq_incremental selalu menghasilkan metrik yang sama dengan perhitungan ulang penuh,
+termasuk saat penulisan history/eq_metrics atau pengambilan feedback gagal.
+Database Supabase diganti dengan implementasi in-memory sederhana.
+"""
+import random
+import sys
+import types
+import unittest
+from datetime import datetime, timedelta, timezone
+
+import app.services  # noqa: E402
+
+_SERVICE_MODULE = "app.services.supabase_service"
+_EQ_MODULE = "app.services.eq_service"
+
+# supabase_service membuat client Supabase saat diimpor; ganti dengan modul palsu sebelum eq_service diimpor.
+# eq_service diimpor ulang agar terikat ke modul palsu; keduanya dikembalikan di tearDownModule.
+_original_modules = {name: sys.modules.pop(name, None) for name in (_SERVICE_MODULE, _EQ_MODULE)}
+_original_attrs = {name: getattr(app.services, name, None) for name in ("supabase_service", "eq_service")}
+_fake_service = types.ModuleType(_SERVICE_MODULE)
+sys.modules[_SERVICE_MODULE] = _fake_service
+
+from app.services import eq_service  # noqa: E402
+
+
+def tearDownModule():
+    for name, module in _original_modules.items():
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
+    for name, module in _original_attrs.items():
+        if module is None:
+            if hasattr(app.services, name):
+                delattr(app.services, name)
+        else:
+            setattr(app.services, name, module)
+
+SNAPSHOTS = [
+    None,
+    "Main.java:3: error: cannot find symbol",
+    "Main.java:4: error: ';' expected",
+    "Main.java:5: error: incompatible types: int cannot be converted",
+    "Main.java:5: error: missing return statement",
+    "Main.java:2: error: illegal start of expression\nMain.java:3: error: cannot find symbol",
+    "Compiled OK",
+]
+
+
+class FakeDB:
+    """Tabel ai_automated_feedbacks, eq_metrics, dan eq_metrics_history di memori."""
+
+    def __init__(self):
+        self.feedback = []
+        self.metrics = {}
+        self.history = {}
+        self.fail_history_writes = 0
+        self.fail_metrics_writes = 0
+        self.fail_feedback_after = None # Jumlah event sebelum iter_feedback_for_user gagal
+
+    def install(self):
+        for name in (
+            "iter_feedback_for_user", "fetch_feedback_times_since", "get_user_eq_metrics",
+            "fetch_latest_eq_metrics_history", "upsert_eq_metrics_history_batch", "upsert_eq_metrics",
+            "fetch_eq_metrics_history_sessions", "delete_eq_metrics_history_by_ids",
+        ):
+            setattr(_fake_service, name, getattr(self, name))
+
+    def _user_feedback(self, user_id, since=None, strictly_after=False):
+        since_dt = eq_service.parse_flexible_isoformat(since) if since else None
+        rows = []
+        for row in self.feedback:
+            if row["user_id"] != user_id:
+                continue
+            created = eq_service.parse_flexible_isoformat(row["created_at"])
+            if since_dt and (created <= since_dt if strictly_after else created < since_dt):
+                continue
+            rows.append(row)
+        return sorted(rows, key=lambda r: eq_service.parse_flexible_isoformat(r["created_at"]))
+
+    def iter_feedback_for_user(self, user_id, batch_size=1000, since=None):
+        for i, row in enumerate(self._user_feedback(user_id, since)):
+            if self.fail_feedback_after is not None and i >= self.fail_feedback_after:
+                raise ConnectionError("feedback page request failed")
+            yield {"error_snapshot": row["error_snapshot"], "created_at": row["created_at"]}
+
+    def fetch_feedback_times_since(self, user_id, since, limit=2):
+        return [{"created_at": r["created_at"]} for r in self._user_feedback(user_id, since, strictly_after=True)[:limit]]
+
+    def get_user_eq_metrics(self, user_id):
+        return dict(self.metrics[user_id]) if user_id in self.metrics else None
+
+    def fetch_latest_eq_metrics_history(self, user_id):
+        keys = [k for k in self.history if k[0] == user_id]
+        if not keys:
+            return None
+        latest = max(keys, key=lambda k: eq_service.parse_flexible_isoformat(k[1]))
+        return dict(self.history[latest])
+
+    def upsert_eq_metrics_history_batch(self, records, on_conflict="user_id,session_start_time"):
+        if self.fail_history_writes:
+            self.fail_history_writes -= 1
+            return False
+        for record in records:
+            self.history[(record["user_id"], record["session_start_time"])] = dict(record)
+        return True
+
+    def upsert_eq_metrics(self, metrics_data):
+        if self.fail_metrics_writes:
+            self.fail_metrics_writes -= 1
+            return False
+        self.metrics[metrics_data["user_id"]] = dict(metrics_data)
+        return True
+
+    def fetch_eq_metrics_history_sessions(self, user_ids):
+        return [{"id": k, "user_id": k[0], "session_start_time": k[1]} for k in self.history if k[0] in user_ids]
+
+    def delete_eq_metrics_history_by_ids(self, record_ids):
+        for record_id in record_ids:
+            self.history.pop(record_id, None)
+
+
+class IncrementalEQTest(unittest.TestCase):
+    USER = "user-1"
+
+    def setUp(self):
+        self.db = FakeDB()
+        self.db.install()
+        self.rng = random.Random(7)
+        self.now = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+    def _add_event(self):
+        self.now += timedelta(minutes=self.rng.choice([1, 3, 10, 25, 31, 90]), seconds=self.rng.randint(0, 59))
+        event = {
+            "user_id": self.USER,
+            "project_id": "p",
+            "created_at": self.now.isoformat(),
+            "error_snapshot": self.rng.choice(SNAPSHOTS),
+        }
+        self.db.feedback.append(event)
+        return event
+
+    def _assert_matches_full_recompute(self):
+        _, expected = eq_service._compute_user_eq(self.USER, self.db._user_feedback(self.USER))
+        stored = self.db.metrics[self.USER]
+        self.assertAlmostEqual(stored["average_eq_score"], expected["average_eq_score"], places=9)
+        self.assertEqual(stored["total_sessions_analyzed"], expected["total_sessions_analyzed"])
+        for key in eq_service.COUNTED_ERROR_TYPES:
+            self.assertEqual(stored[key], expected[key], key)
+
+    def test_incremental_matches_full_recompute(self):
+        for _ in range(120):
+            event = self._add_event()
+            self.assertIsNotNone(eq_service.process_user_eq_incremental(self.USER, new_event=dict(event)))
+            self._assert_matches_full_recompute()
+
+    def test_failed_history_write_does_not_corrupt_metrics(self):
+        for step in range(120):
+            event = self._add_event()
+            if step % 17 == 5:
+                self.db.fail_history_writes = 1
+                self.assertIsNone(eq_service.process_user_eq_incremental(self.USER, new_event=dict(event)))
+                continue
+            self.assertIsNotNone(eq_service.process_user_eq_incremental(self.USER, new_event=dict(event)))
+            self._assert_matches_full_recompute()
+
+    def test_failed_metrics_write_is_repaired_on_next_call(self):
+        for step in range(120):
+            event = self._add_event()
+            if step % 13 == 4:
+                self.db.fail_metrics_writes = 1
+                self.assertIsNone(eq_service.process_user_eq_incremental(self.USER, new_event=dict(event)))
+                continue
+            self.assertIsNotNone(eq_service.process_user_eq_incremental(self.USER, new_event=dict(event)))
+            self._assert_matches_full_recompute()
+
+    def test_interrupted_tail_fetch_skips_metrics_write(self):
+        for _ in range(10):
+            eq_service.process_user_eq_incremental(self.USER, new_event=dict(self._add_event()))
+        before = dict(self.db.metrics[self.USER])
+
+        self.now += timedelta(minutes=1) # Event baru masuk ke sesi terakhir, jadi ekor sesi diambil ulang
+        self.db.feedback.append({"user_id": self.USER, "project_id": "p",
+                                 "created_at": self.now.isoformat(), "error_snapshot": SNAPSHOTS[1]})
+        self.db.fail_feedback_after = 1
+        self.assertIsNone(eq_service.process_user_eq_incremental(self.USER))
+        self.assertEqual(self.db.metrics[self.USER], before)
+
+        self.db.fail_feedback_after = None
+        self.assertIsNotNone(eq_service.process_user_eq_incremental(self.USER))
+        self._assert_matches_full_recompute()
+
+
+if __name__ == "__main__":
+    unittest.main()
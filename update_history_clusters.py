@@ -4,7 +4,7 @@ import logging
 import os
 from dotenv import load_dotenv
 from typing import List, Dict
-import pandas as pd # Import pandas untuk check NaN
+import pandas as pd # Import pandas untuk merge history dengan state akhir
 
 # Impor service Supabase (pastikan path impor benar)
 # Sesuaikan 'app.services' jika struktur folder Anda berbeda
@@ -40,94 +40,70 @@ def run_history_update():
 
     try:
         # 1. Ambil data final dari eq_metrics
-        final_metrics = supabase_service.fetch_all_eq_metrics()
+        final_metrics = supabase_service.fetch_all_eq_metrics(columns="user_id, cluster, performance")
         if not final_metrics:
             logger.warning("No data found in eq_metrics. Ensure initial training has run. Aborting history update.")
             return
 
-        # Buat mapping user_id -> {cluster, performance}
+        # Buat mapping user_id -> (cluster, performance), sudah dinormalisasi (int / None) sekali per user
         user_final_state = {}
         for user_metric in final_metrics:
             user_id = user_metric.get('user_id')
             if user_id:
                  cluster_val = user_metric.get('cluster')
                  perf_val = user_metric.get('performance')
-                 user_final_state[user_id] = {
-                    'cluster': cluster_val,
-                    'performance': perf_val
-                 }
+                 if perf_val is None or str(perf_val).strip() == '':
+                     perf_val = None
+                 user_final_state[user_id] = (
+                    int(cluster_val) if cluster_val is not None else None,
+                    perf_val
+                 )
         logger.info(f"Loaded final state for {len(user_final_state)} users from eq_metrics.")
 
         # 2. Ambil semua data dari eq_metrics_history
-        all_history_records = supabase_service.fetch_all_eq_metrics_history()
+        all_history_records = supabase_service.fetch_all_eq_metrics_history(columns="id, user_id, cluster, performance")
         if not all_history_records:
             logger.warning("No records found in eq_metrics_history to update.")
             return
 
-        # 3. Siapkan batch update untuk history
-        updates_history: List[Dict] = []
-        updated_count = 0
-        skipped_count = 0
-        update_payload_check = {}
-
-        for record in all_history_records:
-            user_id = record.get('user_id')
-            record_id = record.get('id')
-
-            if not user_id or not record_id:
-                skipped_count += 1
-                continue
-
-            if user_id in user_final_state:
-                final_state = user_final_state[user_id]
-                final_cluster = final_state.get('cluster')
-                final_performance = final_state.get('performance')
-
-                if final_performance is None or str(final_performance).strip() == '':
-                     final_performance = None
-
-                needs_update = False
-                current_cluster = record.get('cluster')
-                current_performance = record.get('performance')
-                final_cluster_int = int(final_cluster) if final_cluster is not None else None
-
-                if current_cluster != final_cluster_int:
-                    needs_update = True
-                if current_performance != final_performance:
-                    needs_update = True
-
-                if needs_update:
-                     log_payload = {
-                        'id': record_id,
-                        # --- PERBAIKAN DI SINI: Tambahkan user_id ---
-                        'user_id': user_id,
-                        # --- AKHIR PERBAIKAN ---
-                        'cluster': final_cluster_int,
-                        'performance': final_performance
-                     }
-                     if user_id not in update_payload_check:
-                         update_payload_check[user_id] = log_payload
-                     updates_history.append(log_payload)
-                     updated_count += 1
-                else:
-                    skipped_count += 1
-            else:
-                if record.get('cluster') is not None or record.get('performance') is not None:
-                     updates_history.append({
-                         'id': record_id,
-                         # --- PERBAIKAN DI SINI: Tambahkan user_id ---
-                         'user_id': user_id,
-                         # --- AKHIR PERBAIKAN ---
-                         'cluster': None,
-                         'performance': None
-                     })
-                     updated_count += 1
-                else:
-                    skipped_count += 1
-
-        if update_payload_check:
-             sample_user = list(update_payload_check.keys())[0]
-             logger.info(f"Sample update payload for user {sample_user}: {update_payload_check[sample_user]}")
+        # 3. Siapkan batch update untuk history lewat satu merge (bukan perbandingan per record di Python)
+        # dtype=object: nilai asli (int/None/str) dipertahankan, sehingga perbandingan sama seperti di Python
+        hist_df = pd.DataFrame(all_history_records, columns=['id', 'user_id', 'cluster', 'performance'], dtype=object)
+        final_df = pd.DataFrame(
+            [(user_id, cluster, performance) for user_id, (cluster, performance) in user_final_state.items()],
+            columns=['user_id', 'final_cluster', 'final_performance'], dtype=object
+        )
+        merged = hist_df.merge(final_df, on='user_id', how='left', indicator=True)
+
+        valid = (
+            merged['id'].notna() & merged['id'].astype(bool)
+            & merged['user_id'].notna() & merged['user_id'].astype(bool)
+        )
+        known = valid & (merged['_merge'] == 'both')
+
+        def _same(current: pd.Series, final: pd.Series) -> pd.Series:
+            # None == None dianggap sama (perbandingan pandas menganggap null selalu berbeda)
+            return (current == final) | (current.isna() & final.isna())
+
+        changed = known & ~(
+            _same(merged['cluster'], merged['final_cluster']) & _same(merged['performance'], merged['final_performance'])
+        )
+        # User yang tidak ada lagi di eq_metrics: kosongkan cluster/performance yang masih terisi
+        orphaned = valid & (merged['_merge'] == 'left_only') & (merged['cluster'].notna() | merged['performance'].notna())
+
+        merged.loc[~known, ['final_cluster', 'final_performance']] = None
+        updates_history: List[Dict] = (
+            merged.loc[changed | orphaned, ['id', 'user_id', 'final_cluster', 'final_performance']]
+            .rename(columns={'final_cluster': 'cluster', 'final_performance': 'performance'})
+            .to_dict('records')
+        )
+        updated_count = len(updates_history)
+        skipped_count = len(merged) - updated_count
+
+        if changed.any():
+             sample = merged.loc[changed].iloc[0]
+             sample_payload = {'id': sample['id'], 'user_id': sample['user_id'], 'cluster': sample['final_cluster'], 'performance': sample['final_performance']}
+             logger.info(f"Sample update payload for user {sample['user_id']}: {sample_payload}")
         else:
              logger.info("No update payloads prepared.")
 